@@ -58,13 +58,32 @@ class Cart:
         """Sets the cart's title, from a p8str"""
         m.meta["title"] = from_p8str(value).splitlines()
 
+    @property
+    def code(m):
+        return m._code
+
+    @code.setter
+    def code(m, value):
+        m._code = value
+        m._compress_cache = None
+
+    def get_compress_cache(m, backing=None):
+        """Returns a cache of the cart's compressed code, valid until the code changes"""
+        if m._compress_cache is None or m._compress_cache.backing is not backing:
+            m._compress_cache = MemoryCache(backing)
+        return m._compress_cache
+
     def set_code_without_title(m, code):
         old_title = m.title
         m.code = code
         if old_title != m.title:
             m.title = old_title
 
-def read_code_from_rom(r, keep_compression=False, **opts):
+def compress_cart_code(w, cart, cache=None, timings=None, **opts):
+    with timed_stage(timings, "compress"):
+        compress_code(w, cart.code, cache=cart.get_compress_cache(cache), **opts)
+
+def read_code_from_rom(r, keep_compression=False, timings=None, **opts):
     code_rom = None
     if keep_compression:
         start_pos = r.pos()
@@ -72,7 +91,8 @@ def read_code_from_rom(r, keep_compression=False, **opts):
         code_rom.set_block(0, r.bytes(k_code_size, allow_eof=True))
         r.setpos(start_pos)
 
-    return uncompress_code(r, **opts), code_rom
+    with timed_stage(timings, "decompress"):
+        return uncompress_code(r, **opts), code_rom
 
 def read_cart_from_rom(buffer, path=None, allow_tiny=False, **opts):
     cart = Cart(path=path)
@@ -107,7 +127,7 @@ def write_cart_to_rom(cart, with_trailer=False, keep_compression=False, **opts):
         if keep_compression and cart.code_rom != None:
             w.bytes(cart.code_rom)
         else:
-            compress_code(w, cart.code, **opts)
+            compress_cart_code(w, cart, **opts)
 
         if with_trailer:
             w.setpos(k_cart_size)
@@ -131,7 +151,7 @@ def write_cart_to_tiny_rom(cart, force_compress=False, keep_compression=False, *
             
             w.bytes(cart.code_rom.get_block(0, compressed_size))
         else:
-            compress_code(w, cart.code, force_compress=True, **opts)
+            compress_cart_code(w, cart, force_compress=True, **opts)
 
             if len(io.getvalue()) > len(cart.code):
                 io = BytesIO(encode_p8str(cart.code))
@@ -284,7 +304,7 @@ def write_cart_spritesheet(cart, **_):
 k_p8_prefix = "pico-8 cartridge"
 k_meta_prefix = "meta:"
 
-def read_cart_from_source(data, path=None, raw=False, preprocessor=None, **_):
+def read_cart_from_source(data, path=None, raw=False, preprocessor=None, timings=None, **_):
     cart = Cart(path=path)
     
     def nybbles(line):
@@ -396,7 +416,8 @@ def read_cart_from_source(data, path=None, raw=False, preprocessor=None, **_):
         except Exception as e:
             throw(f"Invalid {header} line in p8 file (line #{line_i + 1})")
             
-    cart.code, cart.code_map = preprocess_code(path, "".join(code), code_line, preprocessor=preprocessor)
+    with timed_stage(timings, "preprocess"):
+        cart.code, cart.code_map = preprocess_code(path, "".join(code), code_line, preprocessor=preprocessor)
     return cart
 
 def write_cart_to_source(cart, unicode_caps=False, sections=None, **_):
@@ -1,5 +1,7 @@
 from utils import *
 from pico_defs import *
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 def print_size(name, size, limit, prefix=None, handler=None):
     if handler and handler != True:
@@ -21,9 +23,27 @@ def print_compressed_size(size, **kwargs):
 def write_code_size(cart, handler=None, input=False):
     print_code_size(len(cart.code), prefix="input" if input else None, handler=handler)
 
-def write_compressed_size(cart, handler=True, debug_handler=None, **opts):
-    compress_code(BinaryWriter(BytesIO()), cart.code, size_handler=handler, debug_handler=debug_handler,
-                  force_compress=True, fail_on_error=False, **opts)
+def write_compressed_size(cart, handler=True, cache=None, timings=None, debug_handler=None, optimal=False, optimal_time_budget=None, **opts):
+    cache = cart.get_compress_cache(cache)
+    with timed_stage(timings, "compress"):
+        if optimal and not debug_handler and not opts.get("old_compress"):
+            # the optimal search knows the exact size of its result, so there's no need to write any bits
+            # (the size is memoized separately from the compressed code, which is reused if it was already written)
+            key = get_compress_cache_key(cart.code, optimal=True, optimal_time_budget=optimal_time_budget)
+            data = cache.get(key) or cache.get(get_compress_cache_key(cart.code, optimal=True, optimal_time_budget=optimal_time_budget, big_end=True))
+            if data is None:
+                size_data = cache.get("size:" + key)
+                if size_data is None:
+                    _, size = get_optimal_pxa_lz77_or_default(cart.code, optimal_time_budget)
+                    size_data = str(size).encode()
+                    cache.set("size:" + key, size_data)
+                size = int(size_data)
+            else:
+                size = len(data)
+            print_compressed_size(size, handler=handler)
+        else:
+            compress_code(BinaryWriter(BytesIO()), cart.code, size_handler=handler, debug_handler=debug_handler, force_compress=True,
+                          fail_on_error=False, optimal=optimal, optimal_time_budget=optimal_time_budget, cache=cache, **opts)
 
 k_old_code_table = [
     None, '\n', ' ', '0', '1', '2', '3', '4', '5', '6', '7', '8', '9', # 00
@@ -37,12 +57,37 @@ k_old_inv_code_table = {ch: i for i, ch in enumerate(k_old_code_table)}
 
 k_old_compressed_code_header = b":c:\0"
 k_new_compressed_code_header = b"\0pxa"
+k_pxa_header_size = 8
 
 def update_mtf(mtf, idx, ch):
-    for ii in range(idx, 0, -1):
-        mtf[ii] = mtf[ii - 1]
+    mtf[1:idx+1] = mtf[:idx]
     mtf[0] = ch
 
+@lru_cache(maxsize=None)
+def get_mtf_position_shift(idx):
+    """a bytes.translate table that updates positions in an mtf table after the char at idx moves to the front"""
+    return bytes(pos + 1 if pos < idx else 0 if pos == idx else pos for pos in range(0x100))
+
+class PxaMtf:
+    """An immutable move-to-front state for the literals of the new compression format, compactly stored as bytes,
+    together with the inverse table (the position of each char), for constant-time lookups.
+    Moving to front creates a new state, so states can be freely shared between alternative ways to compress."""
+    def __init__(m, table=None, positions=None):
+        m.table = bytes(range(0x100)) if table is None else table
+        if positions is None:
+            positions = bytearray(0x100)
+            for pos, ch in enumerate(m.table):
+                positions[ch] = pos
+            positions = bytes(positions)
+        m.positions = positions
+
+    def index(m, ch):
+        return m.positions[ord(ch)]
+
+    def moved_to_front(m, idx):
+        table = m.table
+        return PxaMtf(table[idx:idx+1] + table[:idx] + table[idx+1:], m.positions.translate(get_mtf_position_shift(idx)))
+
 def uncompress_code(r, size_handler=None, debug_handler=None, **_):
     start_pos = r.pos()
     header = r.bytes(4, allow_eof=True)
@@ -54,51 +99,8 @@ def uncompress_code(r, size_handler=None, debug_handler=None, **_):
         if size_handler:
             print_compressed_size(com_size, prefix="input", handler=size_handler)
         
-        mtf = [chr(i) for i in range(0x100)]
-        br = BinaryBitReader(r.f)
-        if debug_handler: debug_handler.init(br)
-        
-        code = []
-        while len(code) < unc_size:
-            if br.bit():
-                extra = 0
-                while br.bit():
-                    extra += 1
-                idx = br.bits(4 + extra) + make_mask(4, extra)
-                
-                if debug_handler: debug_handler.update(mtf[idx])
-                code.append(mtf[idx])
-                
-                update_mtf(mtf, idx, code[-1])
-            else:
-                offlen = (5 if br.bit() else 10) if br.bit() else 15                
-                offset = br.bits(offlen) + 1
-
-                if offset == 1 and offlen != 5:
-                    assert offlen == 10
-                    startlen = len(code)
-                    while True:
-                        ch = br.bits(8)
-                        if ch != 0:
-                            code.append(chr(ch))
-                        else:
-                            break
-                        
-                    if debug_handler: debug_handler.update("".join(code[startlen:]))
-                else:
-                    count = 3
-                    while True:
-                        part = br.bits(3)
-                        count += part
-                        if part != 7:
-                            break
-                    
-                    if debug_handler: debug_handler.update(Lz77Entry(offset, count))
-                    for _ in range(count):
-                        code.append(code[-offset])
-        
-        if debug_handler: debug_handler.end()
-        assert r.pos() == start_pos + com_size
+        code, size = uncompress_pxa_bits(r.bytes(com_size - k_pxa_header_size), unc_size, debug_handler)
+        assert size == com_size - k_pxa_header_size
         assert len(code) == unc_size
 
     elif header == k_old_compressed_code_header:
@@ -126,20 +128,113 @@ def uncompress_code(r, size_handler=None, debug_handler=None, **_):
                 offset = ((ch - 0x3c) << 4) + (ch2 & 0xf)
                 assert count <= offset
                 if debug_handler: debug_handler.update(Lz77Entry(offset, count))                
-                for _ in range(count):
-                    code.append(code[-offset])
+                code += code[-offset:len(code) - offset + count]
 
         if size_handler:
             print_compressed_size(r.pos() - start_pos, prefix="input", handler=size_handler)
 
         if debug_handler: debug_handler.end()
         assert len(code) in (unc_size, unc_size - 1) # extra null at the end dropped?
+        code = "".join(code)
 
     else:
         r.addpos(-len(header))
-        code = [chr(c) for c in r.zbytes(k_code_size, allow_eof=True)]
+        code = r.zbytes(k_code_size, allow_eof=True).decode("latin-1")
+
+    return code
+
+def uncompress_pxa_bits(data, unc_size, debug_handler=None):
+    """Decompress the bits following the header of the new compression format into a string of unc_size chars.
+    Returns the string and the number of bytes consumed"""
+    code = bytearray()
+    mtf = bytearray(range(0x100))
+    acc = nacc = pos = 0 # acc holds nacc not-yet-consumed bits (lsb first) from data[:pos]
+
+    if debug_handler:
+        tracker = BitPositionTracker()
+        debug_handler.init(tracker)
+
+    while len(code) < unc_size:
+        if nacc < 32: # enough for any literal or match header
+            acc |= int.from_bytes(data[pos:pos + 4], "little") << nacc
+            nacc += 32
+            pos += 4
+
+        if acc & 1:
+            ones = (~acc & (acc + 1)).bit_length() - 1 # the literal bit + 'extra' more ones, then a zero
+            extra = ones - 1
+            idx_bits = 4 + extra
+            acc >>= ones + 1
+            idx = (acc & ((1 << idx_bits) - 1)) + make_mask(4, extra)
+            acc >>= idx_bits
+            nacc -= ones + 1 + idx_bits
+            
+            ch = mtf[idx]
+            code.append(ch)
+            mtf[1:idx + 1] = mtf[:idx]
+            mtf[0] = ch
+            
+            if debug_handler:
+                tracker.bit_position = pos * 8 - nacc
+                debug_handler.update(chr(ch))
+        else:
+            if acc & 2:
+                offlen, hdr_bits = (5 if acc & 4 else 10), 3
+            else:
+                offlen, hdr_bits = 15, 2
+            acc >>= hdr_bits
+            offset = (acc & ((1 << offlen) - 1)) + 1
+            acc >>= offlen
+            nacc -= hdr_bits + offlen
+
+            if offset == 1 and offlen != 5:
+                assert offlen == 10
+                startlen = len(code)
+                while True:
+                    if nacc < 8:
+                        acc |= int.from_bytes(data[pos:pos + 4], "little") << nacc
+                        nacc += 32
+                        pos += 4
+                    ch = acc & 0xff
+                    acc >>= 8
+                    nacc -= 8
+                    if ch != 0:
+                        code.append(ch)
+                    else:
+                        break
+                
+                if debug_handler:
+                    tracker.bit_position = pos * 8 - nacc
+                    debug_handler.update(code[startlen:].decode("latin-1"))
+            else:
+                count = 3
+                while True:
+                    if nacc < 3:
+                        acc |= int.from_bytes(data[pos:pos + 4], "little") << nacc
+                        nacc += 32
+                        pos += 4
+                    part = acc & 7
+                    acc >>= 3
+                    nacc -= 3
+                    count += part
+                    if part != 7:
+                        break
+                
+                if debug_handler:
+                    tracker.bit_position = pos * 8 - nacc
+                    debug_handler.update(Lz77Entry(offset, count))
+                
+                assert offset <= len(code)
+                if count <= offset:
+                    code += code[-offset:len(code) - offset + count]
+                else: # overlapping - repeat the last 'offset' chars
+                    code += (code[-offset:] * div_up(count, offset))[:count]
 
-    return "".join(code)
+    if debug_handler: debug_handler.end()
+    
+    bit_size = pos * 8 - nacc
+    assert bit_size <= len(data) * 8 # else, read past the end
+    return code.decode("latin-1"), div_up(bit_size, 8)
 
 def get_compressed_size(r):
     start_pos = r.pos()
@@ -175,46 +270,119 @@ class Lz77Advance(Tuple):
     """A strategy that ends at position 'i' with a given 'cost', using a linked list of lz77/literal/etc items."""
     i = cost = ctxt = item = prev = ...
 
-def get_lz77(code, min_c=3, max_c=0x7fff, max_o=0x7fff, measure=None, min_cost=None, max_o_steps=None, fast_c=None, no_repeat=False, litblock_idxs=None):
-    min_matches = defaultdict(list)
-    next_litblock = litblock_idxs.popleft() if litblock_idxs else len(code)
-
-    def get_match_length(left, left_i, right, right_i, min_c):
-        c = min_c
-        limit = min(len(left) - left_i, len(right) - right_i)
-        while c < limit and left[left_i + c] == right[right_i + c]:
-            c += 1
-        return c
-
-    def find_match(i, max_o=max_o):
-        """find the longest lz77 match at a given position"""
+def get_match_length(code, i, j, c, limit):
+    """return the length of the match between positions i and j of code, given that it's at least c and at most limit"""
+    # compare exponentially growing slices first, then narrow down - much faster than per-item compares for long matches
+    n = 8
+    while c + n <= limit and code[i+c:i+c+n] == code[j+c:j+c+n]:
+        c += n
+        n *= 2
+    while n > 1:
+        n //= 2
+        if c + n <= limit and code[i+c:i+c+n] == code[j+c:j+c+n]:
+            c += n
+    return c
+
+class Lz77MatchFinder:
+    """Finds the longest lz77 matches within code, via hash chains of previous positions keyed by their first few items.
+    Besides the main chains (keyed by min_c items), there are chains keyed by longer prefixes, which are switched to
+    once a long enough match is found, so that only positions that can still improve on it are checked.
+    Positions must be added (via add) before matches can be found at later positions.
+    If max_depth is set, at most that many positions are checked per search, trading compression for speed."""
+
+    def __init__(m, code, min_c=3, max_c=None, max_o=None, no_repeat=False, max_depth=None, key_lens=(12,)):
+        m.code, m.min_c, m.max_c, m.max_o, m.no_repeat, m.max_depth = code, min_c, max_c, max_o, no_repeat, max_depth
+        m.levels = [(key_c, defaultdict(list)) for key_c in (min_c,) + tuple(c for c in key_lens if c > min_c)]
+
+    def add(m, start, end):
+        """add the positions in [start, end) as potential match sources"""
+        code = m.code
+        for key_c, chains in m.levels:
+            for j in range(start, end):
+                chains[code[j:j+key_c]].append(j)
+
+    def find(m, i, max_os=None):
+        """find the longest match at position i within each of the given max offsets (ascending, None meaning no limit),
+        preferring the closest among equally long matches.
+        Returns a (count, j) tuple for each max offset, where count is 0 if no match was found."""
+        code, min_c, no_repeat, depth, levels = m.code, m.min_c, m.no_repeat, m.max_depth, m.levels
+        if max_os is None:
+            max_os = (m.max_o,)
+
+        limit = len(code) - i
+        max_c = limit if m.max_c is None else min(limit, m.max_c)
+
+        level = 0
+        chain = levels[0][1].get(code[i:i+min_c], ())
+        hi = len(chain) # positions in chain[:hi] are yet to be checked, from the end
         best_c, best_j = 0, -1
-        best_slice = type(code)() # e.g. "" if code is an str
-        for j in reversed(min_matches[code[i:i+min_c]]):
-            if best_slice == code[j:j+best_c]: # some speed-up, esp. for cpython
-                c = get_match_length(code, i, code, j, best_c if best_c > 0 else min_c)
-            else:
-                continue
-                
-            if max_c != None:
-                c = min(c, max_c)
-            if no_repeat:
-                c = min(c, i - j)
+        results = []
+
+        for max_o in max_os:
+            while hi:
+                lo = 0 if max_o is None else bisect.bisect_left(chain, i - max_o, 0, hi)
+                if depth != None:
+                    if depth <= 0:
+                        break
+                    lo = max(lo, hi - depth)
+                    depth -= hi - lo
+
+                for idx in range(hi - 1, lo - 1, -1):
+                    j = chain[idx]
+                    if no_repeat and i - j <= best_c:
+                        continue # can't be longer than the best match
+
+                    if best_c:
+                        # cheap checks first - only a longer match can be better, as j is decreasing
+                        if code[j + best_c] != code[i + best_c] or code[j:j+best_c] != code[i:i+best_c]:
+                            continue
+                        c = get_match_length(code, i, j, best_c + 1, limit)
+                    else:
+                        c = get_match_length(code, i, j, min_c, limit)
+
+                    c = min(c, max_c)
+                    if no_repeat:
+                        c = min(c, i - j)
+
+                    if c > best_c and c >= min_c:
+                        best_c, best_j = c, j
+                        if best_c >= max_c:
+                            return results + [(best_c, best_j)] * (len(max_os) - len(results)) # can't do better
+
+                        if level + 1 < len(levels) and levels[level + 1][0] <= best_c + 1:
+                            # switch to a chain containing only positions that match at least as much
+                            while level + 1 < len(levels) and levels[level + 1][0] <= best_c + 1:
+                                level += 1
+                            key_c, chains = levels[level]
+                            chain = chains[code[i:i+key_c]]
+                            hi = bisect.bisect_left(chain, j)
+                            if depth != None:
+                                depth += idx - lo # (unchecked positions are not counted)
+                            break
+                else:
+                    hi = lo
+                    break
 
-            if max_o != None and j < i - max_o:
-                break
+            results.append((best_c, best_j))
 
-            if c > best_c and c >= min_c or c == best_c and j > best_j:
-                best_c, best_j = c, j
-                best_slice = code[i:i+best_c]
-        
-        return best_c, best_j
+        return results
+
+def get_lz77(code, min_c=3, max_c=0x7fff, max_o=0x7fff, measure=None, min_cost=None, max_o_steps=None, fast_c=None, no_repeat=False,
+             litblock_idxs=None, max_depth=None, start=0, on_flush=None):
+    """yield (i, item) pairs covering code from start onwards, where each item is a literal char, a litblock str or an Lz77Entry.
+    on_flush(i, reach) is called whenever all items before i were yielded and nothing pending depends on code[reach:].
+    If it returns true, stop."""
+    finder = Lz77MatchFinder(code, min_c, max_c, max_o, no_repeat, max_depth)
+    finder.add(0, start)
+    find_max_os = tuple(max_o_steps or ()) + (max_o,)
+    next_litblock = litblock_idxs.popleft() if litblock_idxs else len(code)
 
     def mktuple(i, j, count):
         return Lz77Entry(i - j, count)
 
-    i = 0
-    prev_i = 0
+    i = start
+    prev_i = start
+    reach = start # how far code was looked at
     advances = deque() if measure else None # potentially worthwhile ways to go from the current or past positions
     curr_adv = None
 
@@ -265,6 +433,7 @@ def get_lz77(code, min_c=3, max_c=0x7fff, max_o=0x7fff, measure=None, min_cost=N
 
             yield i, code[i:end_litblock]
             i = end_litblock
+            reach = max(reach, i)
 
             next_litblock = litblock_idxs.popleft() if litblock_idxs else len(code)
 
@@ -278,7 +447,9 @@ def get_lz77(code, min_c=3, max_c=0x7fff, max_o=0x7fff, measure=None, min_cost=N
                 add_advance(curr_cost + ch_cost, ch_ctxt, 1, code[i])
 
                 # try using a match
-                best_c, best_j = find_match(i)
+                matches = finder.find(i, find_max_os)
+                best_c, best_j = matches[-1]
+                reach = max(reach, i + best_c + 1)
                 if best_c > 0:
                     lz_item = mktuple(i, best_j, best_c)
                     lz_cost, lz_ctxt = measure(curr_ctxt, lz_item)
@@ -286,11 +457,10 @@ def get_lz77(code, min_c=3, max_c=0x7fff, max_o=0x7fff, measure=None, min_cost=N
 
                 if max_o_steps:
                     # try a shorter yet closer match
-                    for step in max_o_steps:
+                    for step, (sh_best_c, sh_best_j) in zip(max_o_steps, matches):
                         if i - best_j <= step:
                             break
 
-                        sh_best_c, sh_best_j = find_match(i, max_o=step)
                         if sh_best_c > 0:
                             sh_item = mktuple(i, sh_best_j, sh_best_c)
                             sh_cost, sh_ctxt = measure(curr_ctxt, sh_item)
@@ -305,10 +475,12 @@ def get_lz77(code, min_c=3, max_c=0x7fff, max_o=0x7fff, measure=None, min_cost=N
                     curr_adv = None
 
             else:
-                best_c, best_j = find_match(i)
+                best_c, best_j = finder.find(i)[0]
+                reach = max(reach, i + best_c + 1)
                 if best_c > 0:
                     # check for obvious wins of not using matches
-                    skip_best_c, skip_best_j = find_match(i+1)
+                    skip_best_c, skip_best_j = finder.find(i+1)[0]
+                    reach = max(reach, i + skip_best_c + 2)
                     if skip_best_c > best_c:
                         yield i, code[i]
                         i += 1
@@ -320,18 +492,302 @@ def get_lz77(code, min_c=3, max_c=0x7fff, max_o=0x7fff, measure=None, min_cost=N
                     i += 1
         
         if not (fast_c != None and best_c >= fast_c):
-            for j in range(prev_i, i):
-                min_matches[code[j:j+min_c]].append(j)
+            finder.add(prev_i, i)
         prev_i = i
+
+        if on_flush and not curr_adv and on_flush(i, reach):
+            return
     
     assert not curr_adv
 
-def compress_code(w, code, size_handler=None, debug_handler=None, force_compress=False, 
-                  fail_on_error=True, fast_compress=False, old_compress=False, **_):
+k_pxa_min_c = 3
+k_pxa_max_o_steps = (0x20, 0x400, 0x8000) # the offsets that fit in 5, 10 & 15 bits
+
+def get_pxa_literal_cost(ch_i):
+    i_bits = 4
+    while ch_i >= (1 << i_bits):
+        ch_i -= 1 << i_bits
+        i_bits += 1
+    return 1 + (i_bits - 4) + 1 + i_bits # (see write_literal)
+
+k_pxa_literal_costs = [get_pxa_literal_cost(ch_i) for ch_i in range(0x100)]
+
+def get_pxa_match_cost(offset, count):
+    offset_bits = max(round_up(count_significant_bits(offset - 1), 5), 5)
+    count_bits = (((count - k_pxa_min_c) // 7) + 1) * 3
+    return 2 + (offset_bits < 15) + offset_bits + count_bits
+
+def get_pxa_litblock_cost(count):
+    return 21 + count * 8
+
+k_optimal_max_match_step = 0x20 # beyond this, only the longest length of a match is tried
+k_optimal_long_match = 0x20 # positions inside a match this long reuse it instead of searching
+k_optimal_max_depth = 0x200 # (see Lz77MatchFinder)
+k_optimal_max_states = 0x40
+k_optimal_default_time_budget = 1
+
+def find_pxa_match_options(code):
+    """find, for each position of code, the cheapest (cost, count, offset) of each worthwhile match length"""
+    finder = Lz77MatchFinder(code, k_pxa_min_c, max_depth=k_optimal_max_depth)
+    max_o_steps = k_pxa_max_o_steps
+    class_costs = [[get_pxa_match_cost(max_o, c) for c in range(k_optimal_max_match_step + k_pxa_min_c + 1)] for max_o in max_o_steps]
+
+    all_options = []
+    matches = None
+    for i in range(len(code)):
+        if matches and matches[-1][0] > k_optimal_long_match:
+            # we're within a long match - its continuation is very likely the best match here, too
+            matches = [(c - 1, j + 1) if c > k_pxa_min_c else (0, -1) for c, j in matches]
+        else:
+            matches = finder.find(i, max_o_steps)
+        finder.add(i, i + 1)
+        max_c = matches[-1][0]
+
+        options = ()
+        if max_c:
+            # for each length, the closest match is cheapest
+            options = []
+            class_i = 0
+            for c in range(k_pxa_min_c, min(max_c, k_optimal_max_match_step + k_pxa_min_c) + 1):
+                while matches[class_i][0] < c:
+                    class_i += 1
+                options.append((class_costs[class_i][c], c, i - matches[class_i][1]))
+
+            if max_c > k_optimal_max_match_step + k_pxa_min_c:
+                options.append((get_pxa_match_cost(i - matches[-1][1], max_c), max_c, i - matches[-1][1]))
+
+        all_options.append(options)
+    return all_options
+
+def get_optimal_pxa_lz77_with_options(code, match_options, max_states):
+    n = len(code)
+
+    # a state is a tuple of (cost, mtf, prev state, item), where each position keeps its cheapest states, sorted
+    states = [[] for _ in range(n + 1)]
+    states[0].append((0, PxaMtf(), None, None))
+    entry_costs = [sys.maxsize] * (n + 1) # the cost a new state must be below of to get in
+
+    def add_state(i, cost, mtf, prev, item):
+        i_states = states[i]
+        for si, state in enumerate(i_states):
+            if state[1] is mtf: # (same path up to the last literal)
+                if cost >= state[0]:
+                    return
+                del i_states[si]
+                break
+
+        si = len(i_states)
+        while si > 0 and i_states[si - 1][0] > cost:
+            si -= 1
+        i_states.insert(si, (cost, mtf, prev, item))
+        if len(i_states) > max_states:
+            i_states.pop()
+        if len(i_states) == max_states:
+            entry_costs[i] = i_states[-1][0]
+
+    lb_start_cost = lb_start_i = lb_start = None # cheapest start (minus 8 bits per char) of a litblock that can end at the current position
+
+    for i in range(n + 1):
+        if i >= 2:
+            if code[i - 1] == '\0': # litblocks cannot contain nulls
+                lb_start_cost = None
+            elif code[i - 2] != '\0':
+                start = states[i - 2][0]
+                start_cost = start[0] - (i - 2) * 8
+                if lb_start_cost is None or start_cost < lb_start_cost:
+                    lb_start_cost, lb_start_i, lb_start = start_cost, i - 2, start
+
+            if lb_start_cost != None:
+                lb_cost = lb_start_cost + i * 8 + get_pxa_litblock_cost(0)
+                if lb_cost < entry_costs[i]:
+                    add_state(i, lb_cost, lb_start[1], lb_start, code[lb_start_i:i])
+
+            states[i - 2] = None # no longer needed, except via prev links
+
+        if i == n:
+            break
+
+        ch = code[i]
+        options = match_options[i]
+        for state in tuple(states[i]):
+            cost, mtf = state[0], state[1]
+
+            ch_i = mtf.index(ch)
+            ch_cost = cost + k_pxa_literal_costs[ch_i]
+            if ch_cost < entry_costs[i + 1]:
+                add_state(i + 1, ch_cost, mtf.moved_to_front(ch_i), state, ch)
+
+            for lz_cost, c, offset in options:
+                lz_cost += cost
+                if lz_cost < entry_costs[i + c]:
+                    add_state(i + c, lz_cost, mtf, state, Lz77Entry(offset, c))
+
+    state = states[n][0]
+    total_cost = state[0]
+    items = []
+    i = n
+    while state[2]:
+        item = state[3]
+        i -= item.count if isinstance(item, Lz77Entry) else len(item)
+        items.append((i, item))
+        state = state[2]
+    items.reverse()
+    return items, total_cost
+
+def get_optimal_pxa_lz77(code, time_budget=None):
+    """find the cheapest sequence of lz77/literal/litblock items (in the format returned by get_lz77) for code
+    in the new compression format, via a shortest-path search over the exact bit costs of each item.
+    The cost of literals depends on the mtf state, which differs between paths, so only the cheapest path is kept
+    for each position at first - then, while time_budget (in seconds) allows, the search is redone keeping
+    increasingly more paths per position, which approximates the true optimum better.
+    Returns the items and their total cost in bits"""
+    time_budget = default(time_budget, k_optimal_default_time_budget)
+    start_time = time.time()
+    match_options = find_pxa_match_options(code)
+
+    max_states = 1
+    best_items, best_cost = None, sys.maxsize
+    while True:
+        pass_start_time = time.time()
+        items, cost = get_optimal_pxa_lz77_with_options(code, match_options, max_states)
+        if cost < best_cost:
+            best_items, best_cost = items, cost
+
+        # (a pass with twice the states takes about twice the time)
+        end_time = time.time()
+        if max_states >= k_optimal_max_states or end_time + (end_time - pass_start_time) * 2 > start_time + time_budget:
+            break
+        max_states *= 2
+
+    return best_items, best_cost
+
+def get_optimal_pxa_lz77_or_default(code, time_budget=None):
+    """like get_optimal_pxa_lz77, but returns None instead of the items if compress_code's default compression is no larger
+    (which can happen when the time budget ends the search early). Also returns the size of the compressed code, in bytes"""
+    items, num_bits = get_optimal_pxa_lz77(code, time_budget)
+    size = k_pxa_header_size + div_up(num_bits, 8)
+
+    w = BinaryWriter()
+    compress_code(w, code, force_compress=True, fail_on_error=False)
+    default_size = len(w.f.getvalue())
+    return (items, size) if size < default_size else (None, default_size)
+
+class PxaCompressVariant(Tuple):
+    """Tuning parameters of the (non-optimal) compression in the new format"""
+    min_c = k_pxa_min_c # min. length of matches to consider
+    max_o_steps = (0x20, 0x400) # offsets at which to also try shorter yet closer matches
+    fast_c = None # don't search for matches inside matches of this length (or longer)
+    litblock_enter = 19 # cost thresholds for when to enter/leave a litblock (None to disable litblocks)
+    litblock_leave = 0
+
+# the variants tried by compress_code's effort parameter, in order (the first is the default, the rest - by usefulness)
+k_pxa_compress_variants = (
+    PxaCompressVariant(),
+    PxaCompressVariant(max_o_steps=(0x20, 0x100, 0x400, 0x1000)),
+    PxaCompressVariant(litblock_enter=15, litblock_leave=-4),
+    PxaCompressVariant(max_o_steps=(0x20, 0x100, 0x400, 0x1000), litblock_enter=15, litblock_leave=-4),
+    PxaCompressVariant(litblock_enter=None),
+    PxaCompressVariant(max_o_steps=(0x20, 0x80, 0x200, 0x400, 0x2000)),
+    PxaCompressVariant(litblock_enter=23, litblock_leave=4),
+    PxaCompressVariant(min_c=4),
+    PxaCompressVariant(fast_c=0x40),
+)
+
+def print_compression_variant(variant_i, handler=None):
+    """print the variant chosen by compress_code's effort parameter, if sizes are being printed (via 'handler')"""
+    if handler:
+        print(f"best compression variant: #{variant_i} {k_pxa_compress_variants[variant_i]}")
+
+def check_compressed_size(code, size, size_handler=None, fail_on_error=True):
+    if size_handler:
+        print_compressed_size(size, handler=size_handler)
+    
+    if fail_on_error:
+        check(len(code) < 0x10000, "cart has too many characters!")
+        check(size <= k_code_size, "cart takes too much compressed space!")
+
+def get_compress_cache_key(code, old_compress=False, fast_compress=False, optimal=False, optimal_time_budget=None, effort=None, big_end=False):
+    """get the key under which compress_code caches the compressed code (including its header, whose fields depend on big_end)"""
+    if old_compress:
+        kind = "old:fast" if fast_compress else "old"
+    elif optimal:
+        kind = f"pxa:optimal:{optimal_time_budget}"
+    elif fast_compress:
+        kind = "pxa:fast"
+    else:
+        kind = f"pxa:effort:{effort}" if effort and effort > 1 else "pxa"
+    if big_end:
+        kind += ":be"
+    return f"{kind}:{code}"
+
+def compress_code_variant(code, variant_i, big_end):
+    """compress code with the given index of k_pxa_compress_variants, returning the result only if it decompresses correctly"""
+    w = BinaryWriter(big_end=big_end)
+    compress_code(w, code, force_compress=True, fail_on_error=False, variant=k_pxa_compress_variants[variant_i])
+    data = w.f.getvalue()
+    if len(code) >= 0x10000 or len(data) > 0xffff: # can't be decompressed anyway, let compress_code's checks fail it
+        return data
+    if uncompress_code(BinaryReader(BytesIO(data), big_end=big_end)) == code:
+        return data
+
+def compress_code_best_variant(code, effort, big_end):
+    """compress code with the first 'effort' compression variants in parallel, returning the smallest result & its variant's index"""
+    variant_idxs = range(min(effort, len(k_pxa_compress_variants)))
+    try:
+        with ProcessPoolExecutor(min(len(variant_idxs), os.cpu_count() or 1)) as pool:
+            results = list(pool.map(compress_code_variant, itertools.repeat(code), variant_idxs, itertools.repeat(big_end)))
+    except (OSError, ImportError, NotImplementedError, BrokenProcessPool):
+        results = [compress_code_variant(code, i, big_end) for i in variant_idxs] # no multiprocessing
+
+    valid_idxs = [i for i in variant_idxs if results[i] is not None]
+    if not valid_idxs: # (shouldn't happen - but if so, fall back to the default variant, as compress_code would use without effort)
+        w = BinaryWriter(big_end=big_end)
+        compress_code(w, code, force_compress=True, fail_on_error=False)
+        return w.f.getvalue(), 0
+
+    best_i = min(valid_idxs, key=lambda i: len(results[i])) # (ties go to the first)
+    return results[best_i], best_i
+
+def compress_code(w, code, size_handler=None, debug_handler=None, force_compress=False,
+                  fail_on_error=True, fast_compress=False, old_compress=False, optimal=False, optimal_time_budget=None, cache=None,
+                  variant=None, effort=None, incremental=None, **_):
     is_new = not old_compress
     min_c = 3
+    variant = variant or k_pxa_compress_variants[0]
+    use_effort = effort and effort > 1 and is_new and not (optimal or fast_compress or debug_handler)
     
-    if len(code) >= k_code_size or force_compress: # (>= due to null)
+    if cache and not debug_handler and (len(code) >= k_code_size or force_compress):
+        key = get_compress_cache_key(code, old_compress, fast_compress, optimal, optimal_time_budget, effort, w.big_end)
+        data = cache.get(key)
+        variant_i = None
+        if data is None:
+            if use_effort:
+                data, variant_i = compress_code_best_variant(code, effort, w.big_end)
+                cache.set("variant:" + key, str(variant_i).encode())
+            else:
+                cache_w = BinaryWriter(big_end=w.big_end)
+                compress_code(cache_w, code, force_compress=True, fail_on_error=False, fast_compress=fast_compress,
+                              old_compress=old_compress, optimal=optimal, optimal_time_budget=optimal_time_budget)
+                data = cache_w.f.getvalue()
+            cache.set(key, data)
+        elif use_effort:
+            variant_data = cache.get("variant:" + key)
+            if variant_data is not None:
+                variant_i = int(variant_data)
+        
+        if variant_i is not None:
+            print_compression_variant(variant_i, size_handler)
+        w.bytes(data)
+        check_compressed_size(code, len(data), size_handler, fail_on_error)
+
+    elif use_effort and (len(code) >= k_code_size or force_compress):
+        data, variant_i = compress_code_best_variant(code, effort, w.big_end)
+        print_compression_variant(variant_i, size_handler)
+        
+        w.bytes(data)
+        check_compressed_size(code, len(data), size_handler, fail_on_error)
+
+    elif len(code) >= k_code_size or force_compress: # (>= due to null)
         start_pos = w.pos()
         w.bytes(k_new_compressed_code_header if is_new else k_old_compressed_code_header)
         w.u16(len(code) & 0xffff) # only throw under fail_on_error below
@@ -341,7 +797,7 @@ def compress_code(w, code, size_handler=None, debug_handler=None, force_compress
         if is_new:
             bw = BinaryBitWriter(w.f)
             if debug_handler: debug_handler.init(bw)
-            mtf = [chr(i) for i in range(0x100)]
+            mtf = bytearray(range(0x100))
 
             def mtf_cost_heuristic(ch_i):
                 mask = 1 << 4
@@ -353,6 +809,14 @@ def compress_code(w, code, size_handler=None, debug_handler=None, force_compress
                     count -= 1 # heuristic, since mtf generally pays forward
                 return count
 
+            cur_mtf = None # a PxaMtf of mtf, kept up-to-date with all items so far once created
+
+            def get_cur_mtf():
+                nonlocal cur_mtf
+                if cur_mtf is None:
+                    cur_mtf = PxaMtf(bytes(mtf))
+                return cur_mtf
+
             def measure(ctxt_mtf, item):
                 if isinstance(item, Lz77Entry):
                     offset_bits = max(round_up(count_significant_bits(item.offset - 1), 5), 5)
@@ -360,12 +824,11 @@ def compress_code(w, code, size_handler=None, debug_handler=None, force_compress
                     cost = 2 + (offset_bits < 15) + offset_bits + count_bits
 
                 else:
-                    ctxt_mtf = ctxt_mtf or mtf                        
+                    ctxt_mtf = ctxt_mtf or get_cur_mtf()
                     ch_i = ctxt_mtf.index(item)
                     cost = mtf_cost_heuristic(ch_i)
 
-                    ctxt_mtf = ctxt_mtf[:] # a bit wasteful, but doesn't impact perf in practice
-                    update_mtf(ctxt_mtf, ch_i, item)
+                    ctxt_mtf = ctxt_mtf.moved_to_front(ch_i)
 
                 return cost, ctxt_mtf
 
@@ -376,7 +839,7 @@ def compress_code(w, code, size_handler=None, debug_handler=None, force_compress
 
             # heuristicly find at which indices we should enter/leave literal blocks
             def preprocess_litblock_idxs():
-                premtf = [chr(i) for i in range(0x100)]
+                premtf = bytearray(range(0x100))
                 pre_min_c = 4 # ignore questionable lz77s
                 last_cost_len = 0x20
                 last_cost_mask = last_cost_len - 1
@@ -393,7 +856,7 @@ def compress_code(w, code, size_handler=None, debug_handler=None, force_compress
                     last_costs[cost_i] = cost
                     sum_costs += cost
 
-                    if i >= last_cost_len and (not in_litblock and sum_costs > 19) or (in_litblock and sum_costs < 0):
+                    if i >= last_cost_len and (not in_litblock and sum_costs > variant.litblock_enter) or (in_litblock and sum_costs < variant.litblock_leave):
                         in_litblock = not in_litblock
 
                         ordered_costs = last_costs[cost_i + 1:] + last_costs[:cost_i + 1]
@@ -408,8 +871,9 @@ def compress_code(w, code, size_handler=None, debug_handler=None, force_compress
                         for j in range(item.count):
                             add_last_cost(i + j, cost)
                     else:
-                        ch_i = premtf.index(item)
-                        update_mtf(premtf, ch_i, item)
+                        ch = ord(item)
+                        ch_i = premtf.index(ch)
+                        update_mtf(premtf, ch_i, ch)
                         cost = mtf_cost_heuristic(ch_i)
                         add_last_cost(i, cost - 8)                        
 
@@ -436,8 +900,10 @@ def compress_code(w, code, size_handler=None, debug_handler=None, force_compress
                 bw.bits(3, count_val)
 
             def write_literal(ch):
+                nonlocal cur_mtf
                 bw.bit(1)
-                ch_i = mtf.index(ch)
+                ch_i = get_cur_mtf().index(ch)
+                ch = ord(ch)
                 
                 i_val = ch_i 
                 i_bits = 4
@@ -449,7 +915,8 @@ def compress_code(w, code, size_handler=None, debug_handler=None, force_compress
                 bw.bit(0)
                 bw.bits(i_bits, i_val)
                                 
-                update_mtf(mtf, ch_i, ch)
+                update_mtf(mtf, ch_i, ch) # (still needed by incremental)
+                cur_mtf = cur_mtf.moved_to_front(ch_i)
 
             def write_litblock(str):
                 bw.bit(0); bw.bit(1); bw.bit(0)
@@ -459,11 +926,21 @@ def compress_code(w, code, size_handler=None, debug_handler=None, force_compress
                     bw.bits(8, ord(ch))
                 bw.bits(8, 0)
 
-            if fast_compress:
+            optimal_items = get_optimal_pxa_lz77_or_default(code, optimal_time_budget)[0] if optimal else None
+            if optimal_items is not None:
+                items = optimal_items
+            elif fast_compress and not optimal: # (optimal falls back to the default compression)
                 items = get_lz77(code, min_c=min_c, max_c=None, fast_c=16)
+            elif incremental:
+                litblock_idxs, start = incremental.begin(bw, mtf, preprocess_litblock_idxs)
+                items = itertools.chain(get_lz77(code, min_c=variant.min_c, max_c=None, measure=measure, min_cost=min_cost, fast_c=variant.fast_c,
+                                                 max_o_steps=variant.max_o_steps, litblock_idxs=litblock_idxs, start=start,
+                                                 on_flush=incremental.on_flush),
+                                        incremental.get_replayed_items())
             else:
-                items = get_lz77(code, min_c=min_c, max_c=None, measure=measure, min_cost=min_cost,
-                                 max_o_steps=(0x20, 0x400), litblock_idxs=preprocess_litblock_idxs())
+                litblock_idxs = None if variant.litblock_enter is None else preprocess_litblock_idxs()
+                items = get_lz77(code, min_c=variant.min_c, max_c=None, measure=measure, min_cost=min_cost, fast_c=variant.fast_c,
+                                 max_o_steps=variant.max_o_steps, litblock_idxs=litblock_idxs)
 
             for i, item in items:
                 if isinstance(item, Lz77Entry):
@@ -473,8 +950,10 @@ def compress_code(w, code, size_handler=None, debug_handler=None, force_compress
                 else:
                     write_litblock(item)
                 if debug_handler: debug_handler.update(item)
+                if incremental: incremental.add_item(item)
                     
             if debug_handler: debug_handler.end()
+            if incremental: incremental.end(bw)
             bw.flush()
 
         else:
@@ -515,12 +994,7 @@ def compress_code(w, code, size_handler=None, debug_handler=None, force_compress
             if debug_handler: debug_handler.end()
 
         size = w.pos() - start_pos
-        if size_handler:
-            print_compressed_size(size, handler=size_handler)
-        
-        if fail_on_error:
-            check(len(code) < 0x10000, "cart has too many characters!")
-            check(size <= k_code_size, "cart takes too much compressed space!")
+        check_compressed_size(code, size, size_handler, fail_on_error)
         
         if is_new:   
             w.setpos(len_pos)
@@ -529,6 +1003,178 @@ def compress_code(w, code, size_handler=None, debug_handler=None, force_compress
     else:
         w.bytes(encode_p8str(code))
 
+k_pxa_checkpoint_interval = 0x40 # min. chars between the checkpoints of a PxaCompressResult
+
+class PxaCheckpoint(Tuple):
+    """A point in the compression of code where the compressor's state can be restored from, consisting of:
+    the position in the code, the position in the compressed bits, the mtf state, how many litblock idxs were
+    consumed, and how far the code was looked at (only code before that affects anything up to this point)"""
+    i = bit_pos = mtf = num_litblock_idxs = reach = ...
+
+class PxaCompressResult:
+    """The result of compress_code_incremental, to be passed back to it when compressing an edited version of the code"""
+    def __init__(m, code, data, bit_size, items, checkpoints, litblock_idxs):
+        m.code, m.data, m.bit_size = code, data, bit_size
+        m.items, m.checkpoints, m.litblock_idxs = items, checkpoints, litblock_idxs
+        m.checkpoint_idxs = {cp.i: cp_i for cp_i, cp in enumerate(checkpoints)}
+
+class PxaIncrementalState:
+    """Tracks the compression of code done by compress_code_incremental, resuming from & re-syncing with a previous result"""
+    def __init__(m, code, prev, resync):
+        m.code, m.prev, m.resync = code, prev, resync
+        m.items, m.checkpoints = [], []
+        m.synced_cp = None
+
+        if prev:
+            prev_code = prev.code
+            max_common = min(len(code), len(prev_code))
+            m.change_start = 0 # the change is at [change_start, change_end) in the new code, [change_start, prev_change_end) in prev's
+            while m.change_start < max_common and code[m.change_start] == prev_code[m.change_start]:
+                m.change_start += 1
+            suffix = 0
+            while suffix < max_common - m.change_start and code[-suffix - 1] == prev_code[-suffix - 1]:
+                suffix += 1
+            m.change_end, m.prev_change_end = len(code) - suffix, len(prev_code) - suffix
+            m.delta = len(code) - len(prev_code)
+            m.last_bad_i, m.last_moved_i = m.get_last_changed_matches()
+
+    @staticmethod
+    def get_litblock_state(idxs, num_consumed):
+        """the litblock idxs that still affect compression once num_consumed of them were consumed by get_lz77"""
+        if num_consumed % 2: # the last consumed idx is still pending
+            return idxs[num_consumed - 1:]
+        return idxs[num_consumed:]
+
+    def get_moved_match(m, i, item):
+        """return the item in prev's code at i, adjusted to the new code (if it's a match whose source moved), or None if invalid"""
+        if isinstance(item, Lz77Entry):
+            src_start = i - item.offset
+            if src_start + item.count <= m.change_start:
+                if m.delta:
+                    offset = item.offset + m.delta
+                    return Lz77Entry(offset, item.count) if offset <= k_pxa_max_o_steps[-1] else None
+            elif src_start < m.prev_change_end:
+                return None
+        return item
+
+    def get_last_changed_matches(m):
+        """return the positions of the last match in prev (after the change) that can't be reused in the new code,
+        and the last one that can be reused only with a different offset"""
+        last_bad_i = last_moved_i = -1
+        for i, item in m.prev.items:
+            if i >= m.prev_change_end and isinstance(item, Lz77Entry):
+                src_start = i - item.offset
+                if src_start < m.prev_change_end:
+                    new_item = m.get_moved_match(i, item)
+                    if new_item is None:
+                        last_bad_i = i
+                    elif new_item != item:
+                        last_moved_i = i
+        return last_bad_i, last_moved_i
+
+    def get_replayed_items(m):
+        """after re-syncing, yield prev's items (adjusted to the new code) until the point where prev's bits can be reused as-is"""
+        if m.synced_cp:
+            prev_cps = m.prev.checkpoints
+            cp_i = m.prev.checkpoint_idxs[m.synced_cp.i]
+            while cp_i < len(prev_cps) and prev_cps[cp_i].i <= m.last_moved_i:
+                cp_i += 1
+            m.reused_cp = prev_cps[cp_i] if cp_i < len(prev_cps) else None
+
+            end_i = m.reused_cp.i if m.reused_cp else len(m.prev.code)
+            for i, item in m.prev.items:
+                if m.synced_cp.i <= i < end_i:
+                    yield i + m.delta, m.get_moved_match(i, item)
+
+    def begin(m, bw, mtf, get_litblock_idxs):
+        """start compressing, returning the litblock idxs to use & the position to start from"""
+        m.bw, m.mtf = bw, mtf
+        m.base_bit_pos = bw.bit_position
+        m.litblock_idxs = tuple(get_litblock_idxs() or ())
+        
+        if m.prev:
+            # find the last checkpoint unaffected by the change (incl. its effect on the litblock idxs)
+            prev_idxs, prev_cps = m.prev.litblock_idxs, m.prev.checkpoints
+            cp_i = len(prev_cps) - 1
+            while prev_cps[cp_i].reach > m.change_start or \
+                    m.litblock_idxs[:prev_cps[cp_i].num_litblock_idxs] != prev_idxs[:prev_cps[cp_i].num_litblock_idxs]:
+                cp_i -= 1
+            cp = prev_cps[cp_i]
+            m.checkpoints.extend(prev_cps[:cp_i + 1])
+            m.items.extend(item for item in m.prev.items if item[0] < cp.i)
+            m.prev_shifted_idxs = tuple(i + m.delta for i in prev_idxs)
+
+            mtf[:] = cp.mtf
+            prev_data = m.prev.data[k_pxa_header_size:]
+            bw.many_bits_le(cp.bit_pos, int.from_bytes(prev_data[:div_up(cp.bit_pos, 8)], "little"))
+            litblock_idxs = deque(m.get_litblock_state(m.litblock_idxs, cp.num_litblock_idxs))
+            start = cp.i
+        else:
+            litblock_idxs = deque(m.litblock_idxs)
+            m.checkpoints.append(PxaCheckpoint(0, 0, bytes(mtf), 0, 0))
+            start = 0
+
+        m.litblock_deque = litblock_idxs
+        m.next_i = start
+        return litblock_idxs, start
+
+    def add_item(m, item):
+        m.items.append((m.next_i, item))
+        m.next_i += item.count if isinstance(item, Lz77Entry) else len(item)
+
+    def on_flush(m, i, reach):
+        num_litblock_idxs = len(m.litblock_idxs) - len(m.litblock_deque)
+        
+        if m.resync and m.prev and i >= m.change_end:
+            prev_cp_i = m.prev.checkpoint_idxs.get(i - m.delta)
+            if prev_cp_i is not None:
+                prev_cp = m.prev.checkpoints[prev_cp_i]
+                if (prev_cp.i > m.last_bad_i and prev_cp.mtf == m.mtf and
+                        m.get_litblock_state(m.litblock_idxs, num_litblock_idxs) == 
+                        m.get_litblock_state(m.prev_shifted_idxs, prev_cp.num_litblock_idxs)):
+                    m.synced_cp = prev_cp
+                    m.litblock_idx_delta = num_litblock_idxs - prev_cp.num_litblock_idxs
+                    return True
+
+        if i >= m.checkpoints[-1].i + k_pxa_checkpoint_interval:
+            m.checkpoints.append(PxaCheckpoint(i, m.bw.bit_position - m.base_bit_pos, bytes(m.mtf), num_litblock_idxs, reach))
+
+    def end(m, bw):
+        cp = m.reused_cp if m.synced_cp else None
+        if cp:
+            # the rest of the compressed bits are identical to prev's
+            prev_data = m.prev.data[k_pxa_header_size:]
+            tail = int.from_bytes(prev_data[cp.bit_pos // 8:], "little") >> (cp.bit_pos % 8)
+            bit_delta = bw.bit_position - m.base_bit_pos - cp.bit_pos
+            bw.many_bits_le(m.prev.bit_size - cp.bit_pos, tail)
+
+            prev_cps = m.prev.checkpoints
+            for prev_cp in prev_cps[m.prev.checkpoint_idxs[cp.i]:]:
+                m.checkpoints.append(PxaCheckpoint(prev_cp.i + m.delta, prev_cp.bit_pos + bit_delta, prev_cp.mtf,
+                                                   prev_cp.num_litblock_idxs + m.litblock_idx_delta, prev_cp.reach + m.delta))
+            m.items.extend((i + m.delta, item) for i, item in m.prev.items if i >= cp.i)
+
+        m.bit_size = bw.bit_position - m.base_bit_pos
+
+def compress_code_incremental(code, prev=None, resync=False):
+    """Compress code in the new format, returning a PxaCompressResult.
+    If prev - the result of compressing an earlier version of the code - is given, compression resumes from the last
+    checkpoint before the first change. The compressed data is then the same as compress_code's (if prev's was).
+    If resync is true, compression also stops once it re-syncs with prev after the last change, reusing prev's bits.
+    This is much faster for changes near the start, but the result may be a few bytes off from compress_code's,
+    since prev's choices after the change don't account for matches into the changed code."""
+    if prev and prev.code == code:
+        return prev
+    
+    state = PxaIncrementalState(code, prev, resync)
+    w = BinaryWriter(big_end=True)
+    compress_code(w, code, force_compress=True, fail_on_error=False, incremental=state)
+    return PxaCompressResult(code, w.f.getvalue(), state.bit_size, state.items, state.checkpoints, state.litblock_idxs)
+
+class BitPositionTracker:
+    """Reports the bit position of a decompressor that reads bits by itself, to a debug_handler"""
+    bit_position = 0
+
 class CompressionTracer:
     """a debug_handler that traces compression to a file"""
     def __init__(m, path):
@@ -540,7 +1186,7 @@ class CompressionTracer:
         m.code = []
     
     def curr_bitpos(m):
-        if isinstance(m.reader, (BinaryBitReader, BinaryBitWriter)):
+        if isinstance(m.reader, (BinaryBitReader, BinaryBitWriter, BitPositionTracker)):
             return m.reader.bit_position
         elif isinstance(m.reader, (BinaryReader, BinaryWriter)):
             return m.reader.position * 8
@@ -3,7 +3,12 @@ from sdl2_utils import Surface, Color, Palette, PixelFormat
 from pico_defs import *
 from pico_cart import CartFormat, write_cart, read_cart_from_rom, write_cart_to_rom
 from pico_cart import read_cart_from_source, write_cart_to_source, create_screenshot_surface
-from pico_compress import get_lz77, Lz77Entry
+from pico_compress import get_match_length
+
+try:
+    import lz4.block as lz4_block # optional, faster (for decompression)
+except ImportError:
+    lz4_block = None
 
 class ListOp(Enum):
     insert = replace = delete = rename = ...
@@ -237,7 +242,7 @@ class PodFile:
                     size = r.u32()
                     name = r.zstr(0x40)
                     if header == m.k_cmpr_file_header:
-                        content = m.lz4_uncompress(r.bytes(r.u32()))
+                        content = m.lz4_uncompress(r.bytes(r.u32()), size)
                     else:
                         content = r.bytes(size)
                 
@@ -249,7 +254,7 @@ class PodFile:
                     check(r.u32() == 0, "unknown POD bmp header value")
                     check(r.u32() == 0, "unknown POD bmp header value")
                     if header == m.k_cmpr_bmp_header:
-                        data = m.lz4_uncompress(r.bytes(r.u32()))
+                        data = m.lz4_uncompress(r.bytes(r.u32()), size - 0x14)
                     else:
                         data = r.bytes(size - 0x14)
                     
@@ -439,87 +444,106 @@ class PodFile:
         else:
             file_write(path_join(dest, filename_fixup(name)), content)
 
-    def lz4_uncompress(m, data):
-        def read_u8_sum(r):
-            sum = 0
-            while True:
-                val = r.u8()
-                sum += val
-                if val != 0xff:
-                    return sum
+    def lz4_uncompress(m, data, unc_size=None):
+        if lz4_block and unc_size is not None:
+            return lz4_block.decompress(data, uncompressed_size=unc_size)
 
+        data = memoryview(data)
         uncdata = bytearray()
-        with BinaryReader(BytesIO(data)) as r:
-            while not r.eof():
-                header = r.u8()
-                size = header >> 4
-                if size == 0xf:
-                    size += read_u8_sum(r)
-                
-                for i in range(size):
-                    uncdata.append(r.u8())
+        pos = 0
+
+        def read_u8_sum(size):
+            nonlocal pos
+            while True:
+                val = data[pos]
+                pos += 1
+                size += val
+                if val != 0xff:
+                    return size
+
+        while pos < len(data):
+            header = data[pos]
+            pos += 1
+            size = header >> 4
+            if size == 0xf:
+                size = read_u8_sum(size)
+            
+            uncdata += data[pos:pos + size]
+            pos += size
+            
+            if pos < len(data):
+                offset = data[pos] | (data[pos + 1] << 8)
+                pos += 2
+                count = 4 + (header & 0xf)
+                if count == 0x13:
+                    count = read_u8_sum(count)
                 
-                if not r.eof():
-                    offset = r.u16()
-                    count = 4 + (header & 0xf)
-                    if count == 0x13:
-                        count += read_u8_sum(r)
-                    
-                    for i in range(count):
-                        uncdata.append(uncdata[-offset])
+                start = len(uncdata) - offset
+                check(offset and start >= 0, "invalid lz4 data")
+                if count <= offset:
+                    uncdata += uncdata[start:start + count]
+                else: # overlapping - repeat the last 'offset' bytes
+                    uncdata += (uncdata[start:] * div_up(count, offset))[:count]
         
         return bytes(uncdata)
 
     def lz4_compress(m, uncdata):
-        literals = []
+        # (the lz4 module isn't used here, as its output differs from this, which would make exports differ between machines)
+        uncdata = bytes(uncdata)
         min_c = 4
+        end_of_lz77_reach = len(uncdata) - 5 # (lz4 requires the last 5 bytes to be literals)
+        end_of_lz77s = len(uncdata) - 12 # (and the last match to start 12 bytes before the end)
+
+        compressed = bytearray()
+        def write_u8_sum(val):
+            compressed.extend(b"\xff" * (val // 0xff))
+            compressed.append(val % 0xff)
+
+        def write_block(lit_start, lit_end, offset, count):
+            size = lit_end - lit_start
+            count_val = count - min_c if count else 0
+            compressed.append(min(count_val, 0xf) | (min(size, 0xf) << 4))
+            if size >= 0xf:
+                write_u8_sum(size - 0xf)
+            compressed.extend(uncdata[lit_start:lit_end])
+            
+            if count:
+                compressed.append(offset & 0xff)
+                compressed.append(offset >> 8)
+                if count_val >= 0xf:
+                    write_u8_sum(count_val - 0xf)
+
+        # the usual lz4 approach - a single probe into a table of the last position of each 4-byte sequence,
+        # skipping ahead faster the longer no match is found
+        table = {}
+        lit_start = i = 0
+        misses = 0
+        while i < end_of_lz77s:
+            key = uncdata[i:i + min_c]
+            j = table.get(key)
+            table[key] = i
+
+            if j is None or i - j > 0xffff:
+                misses += 1
+                i += 1 + (misses >> 6)
+                continue
 
-        with BinaryWriter() as w:
-            def write_u8_sum(val):
-                while True:
-                    byte = min(val, 0xff)
-                    w.u8(byte)
-                    val -= byte
-                    if byte != 0xff:
-                        break
-
-            def write_block(item):
-                size = len(literals)
-                count = (item.count - min_c) if item else 0
-
-                w.u8(min(count, 0xf) | (min(size, 0xf) << 4))
-                if size >= 0xf:
-                    write_u8_sum(size - 0xf)
-                
-                for lit in literals:
-                    w.u8(lit)
-                literals.clear()
-
-                if item:
-                    w.u16(item.offset)
-                    if count >= 0xf:
-                        write_u8_sum(count - 0xf)
-
-            end_of_lz77_reach = len(uncdata) - 5
-            end_of_lz77s = len(uncdata) - 12
-
-            for i, item in get_lz77(uncdata, min_c=min_c, max_c=None, max_o=0xffff):
-                if isinstance(item, Lz77Entry):
-                    if i < end_of_lz77s:
-                        if i + item.count <= end_of_lz77_reach:
-                            write_block(item)
-                        else:
-                            fixed_item = Lz77Entry(item.offset, end_of_lz77_reach - i)
-                            assert fixed_item.count >= min_c
-                            write_block(fixed_item)
-                            literals.extend(uncdata[end_of_lz77_reach:i+item.count])
-                    else:                    
-                        literals.extend(uncdata[i:i+item.count])
-                else:
-                    literals.append(item)
-            write_block(None)
+            count = get_match_length(uncdata, i, j, min_c, end_of_lz77_reach - i)
+            while i > lit_start and j > 0 and uncdata[i - 1] == uncdata[j - 1]: # extend backwards
+                i -= 1
+                j -= 1
+                count += 1
+
+            write_block(lit_start, i, i - j, count)
+            i += count
+            lit_start = i
+            misses = 0
+            
+            if i - 2 < end_of_lz77s:
+                table[uncdata[i - 2:i - 2 + min_c]] = i - 2
 
-            return w.f.getvalue()
+        write_block(lit_start, len(uncdata), 0, 0)
+        return bytes(compressed)
 
 class PodExport(CartExport, PodFile):
     """A .pod file used in exports, containing one or more carts"""
@@ -1,7 +1,6 @@
 from utils import *
 from pico_tokenize import TokenType, tokenize, Token, k_char_escapes, CommentHint
-from pico_tokenize import parse_string_literal, parse_fixnum, k_keep_prefix
-from pico_tokenize import StopTraverse, k_skip_children
+from pico_tokenize import parse_string_literal, parse_fixnum, k_keep_prefix, TraverseVisitor
 from pico_parse import Node, NodeType, VarKind, k_invalid
 from pico_parse import k_unary_ops_prec, k_binary_op_precs, k_right_binary_ops
 from pico_parse import is_vararg_expr, is_short_block_stmt, is_global_or_builtin_local
@@ -137,7 +136,9 @@ def get_node_bodies(node):
     else:
         yield node.body
 
-def analyze_code_for_minify(root, focus):
+def get_minify_analyzer(focus):
+    """Returns a TraverseVisitor that analyzes the code for minify_code (e.g. as part of another walk, via traverse_nodes_multi),
+    and a function returning the analysis once the walk is done"""
     shorts = CounterDictionary()
     longs = CounterDictionary()
     shortenables = set()
@@ -184,20 +185,26 @@ def analyze_code_for_minify(root, focus):
             else:
                 longs[node.type] += weight
 
-    root.traverse_nodes(post=analyze_node_post)
+    def get_analysis():
+        new_shorts = {}
+        for type in (NodeType.if_, NodeType.while_):
+            # if everything can be made short, that's always best.
+            # else, consistency is better for compression while more shorts are better for chars
+            if focus.chars or not longs[type] or (not focus.compressed and longs[type] * 1.5 <= shorts[type]):
+                new_shorts[type] = True
+            elif focus.compressed:
+                new_shorts[type] = False
+            else:
+                new_shorts[type] = None # leave alone
 
-    new_shorts = {}
-    for type in (NodeType.if_, NodeType.while_):
-        # if everything can be made short, that's always best.
-        # else, consistency is better for compression while more shorts are better for chars
-        if focus.chars or not longs[type] or (not focus.compressed and longs[type] * 1.5 <= shorts[type]):
-            new_shorts[type] = True
-        elif focus.compressed:
-            new_shorts[type] = False
-        else:
-            new_shorts[type] = None # leave alone
+        return Dynamic(new_shorts=new_shorts, shortenables=shortenables)
 
-    return Dynamic(new_shorts=new_shorts, shortenables=shortenables)
+    return TraverseVisitor(post=analyze_node_post), get_analysis
+
+def analyze_code_for_minify(root, focus):
+    visitor, get_analysis = get_minify_analyzer(focus)
+    root.traverse_nodes(post=visitor.post)
+    return get_analysis()
 
 def minify_change_shorthand(node, new_short):
     if new_short:
@@ -236,53 +243,83 @@ def minify_change_shorthand(node, new_short):
         else:
             node.append_token(TokenType.keyword, "end", near_next=True)
 
-def node_contains_vars(root, vars):
-    def visitor(node):
-        if node.type == NodeType.var and node.var in vars:
-            raise StopTraverse()
-
-    try:
-        root.traverse_nodes(visitor, extra=True)
-        return False
-    except StopTraverse:
-        return True
-
-def expr_is_trivial(root, ctxt, safe_only, allow_member=True, allow_index=True, allow_call=True):
-    def visitor(expr):
-        # nodes that cannot call user-defined code in any case
-        if expr.type in (NodeType.const, NodeType.varargs, NodeType.group,
-                         NodeType.table, NodeType.table_member, NodeType.table_index): # (since new tables have no metatable)
-            pass
-        elif expr.type == NodeType.var and expr.kind != VarKind.global_:
-            pass
-        elif expr.type == NodeType.unary_op and expr.op == "not":
-            pass
-        elif expr.type == NodeType.binary_op and expr.op in ("and", "or"):
-            pass
-        elif expr.type == NodeType.function:
-            assert not expr.target # we only traverse expressions!
-            return k_skip_children
-        # nodes that may call user-defined code
-        elif expr.type == NodeType.call:
-            func = expr.func
-            if safe_only or not allow_call or \
-                    not (func.type == NodeType.var and is_global_or_builtin_local(func) and not func.var.reassigned and func.name not in ctxt.callback_builtins):
-                raise StopTraverse()
-        elif expr.type == NodeType.member and not allow_member:
-            raise StopTraverse()
-        elif expr.type == NodeType.index and not allow_index:
-            raise StopTraverse()
-        # nodes that may call user-defined code via metatables (E.g. member access, operators)
-        elif safe_only:
-            raise StopTraverse()
-    
-    try:
-        root.traverse_nodes(visitor)
-        return True
-    except StopTraverse:
-        return False
+class ExprEffects(Bitmask):
+    """What evaluating an expression may do that a reordering must be wary of"""
+    call = ... # calls a function (even if a builtin)
+    user_call = ... # may call user-defined code directly
+    member = index = ... # accesses a table member/index (may call user-defined code via metatables)
+    other = ... # may call user-defined code via metatables (E.g. operators, global access)
+    none = 0
 
-def minify_merge_assignments(prev, next, ctxt, safe_only):
+class NodeSummary(Tuple):
+    """The 'vars' referenced anywhere in a node's subtree, and the 'effects' of evaluating it (excluding those of function bodies)"""
+    vars = effects = ...
+
+# nodes that cannot call user-defined code in any case
+k_effectless_expr_types = {NodeType.const, NodeType.varargs, NodeType.group, NodeType.function,
+                           NodeType.table, NodeType.table_member, NodeType.table_index} # (since new tables have no metatable)
+
+def get_expr_effects(expr, ctxt):
+    type = expr.type
+    if type in k_effectless_expr_types:
+        return ExprEffects.none
+    elif type == NodeType.var:
+        return ExprEffects.other if expr.kind == VarKind.global_ else ExprEffects.none
+    elif type == NodeType.unary_op and expr.op == "not":
+        return ExprEffects.none
+    elif type == NodeType.binary_op and expr.op in ("and", "or"):
+        return ExprEffects.none
+    # nodes that may call user-defined code
+    elif type == NodeType.call:
+        func = expr.func
+        if func.type == NodeType.var and is_global_or_builtin_local(func) and not func.var.reassigned and func.name not in ctxt.callback_builtins:
+            return ExprEffects.call
+        else:
+            return ExprEffects.call | ExprEffects.user_call
+    elif type == NodeType.member:
+        return ExprEffects.member
+    elif type == NodeType.index:
+        return ExprEffects.index
+    # nodes that may call user-defined code via metatables (E.g. operators, global access)
+    else:
+        return ExprEffects.other
+
+def summarize_node(node, summaries, ctxt):
+    """Compute the summary of 'node' from those of its children (incl. extra children), which must already be in 'summaries'"""
+    effects = get_expr_effects(node, ctxt)
+    var_sets = [frozenset((node.var,))] if node.type == NodeType.var else []
+    is_function = node.type == NodeType.function
+
+    for child in itertools.chain(node.children, getattr(node, "extra_children", ())):
+        if isinstance(child, Node):
+            summary = summaries[child]
+            if summary.vars:
+                var_sets.append(summary.vars)
+            if summary.effects and not is_function: # (function bodies don't run when the function is evaluated)
+                effects |= summary.effects
+
+    # (share the set of a lone child with vars, to avoid copying sets up long chains of nodes)
+    vars = var_sets[0] if len(var_sets) == 1 else frozenset().union(*var_sets)
+    summaries[node] = NodeSummary(vars, effects)
+
+def get_node_summary(node, summaries, ctxt):
+    """Return the summary of 'node', first summarizing it - and any descendants not yet in 'summaries' - in one post-order pass"""
+    if node not in summaries:
+        def summarize_post(node):
+            if node not in summaries:
+                summarize_node(node, summaries, ctxt)
+
+        node.traverse_nodes(lambda node: node in summaries, summarize_post, extra=True)
+    return summaries[node]
+
+def expr_is_trivial(summary, safe_only, allow_member=True, allow_index=True, allow_call=True):
+    effects = summary.effects
+    if safe_only:
+        return not effects
+    return not (effects.user_call or (effects.call and not allow_call) or
+                (effects.member and not allow_member) or (effects.index and not allow_index))
+
+def minify_merge_assignments(prev, next, ctxt, safe_only, summaries):
     if len(prev.targets) < len(prev.sources):
         return
     if len(prev.targets) > len(prev.sources) and \
@@ -297,15 +334,15 @@ def minify_merge_assignments(prev, next, ctxt, safe_only):
 
     require_trivial = False # True when prev.targets may be accessed indirectly from functions that may be called by next.soources
     allow_index = allow_member = True
-    target_vars = []
+    target_vars = set()
     for target in prev.targets:
         if target.type == NodeType.var:
-            target_vars.append(target.var)
+            target_vars.add(target.var)
             # is it possible for 'next' to access 'target' without refering to it directly? (via function call)
             if target.kind == VarKind.global_ or (prev.type == NodeType.assign and target.var.captured):
                 require_trivial = True
         elif target.type == NodeType.member:
-            target_vars.append(target.key.var)
+            target_vars.add(target.key.var)
             require_trivial = True
             allow_index = False # TODO: could rely on rename's preserve logic
         elif target.type == NodeType.index:
@@ -316,15 +353,17 @@ def minify_merge_assignments(prev, next, ctxt, safe_only):
             return
     
     for node in next.sources:
-        if target_vars and node_contains_vars(node, target_vars):
+        summary = get_node_summary(node, summaries, ctxt)
+        if not summary.vars.isdisjoint(target_vars):
             return
-        if require_trivial and not expr_is_trivial(node, ctxt, safe_only, allow_member, allow_index):
+        if require_trivial and not expr_is_trivial(summary, safe_only, allow_member, allow_index):
             return
         
     for node in next.targets:
-        if target_vars and node_contains_vars(node, target_vars):
+        summary = get_node_summary(node, summaries, ctxt)
+        if not summary.vars.isdisjoint(target_vars):
             return
-        if require_trivial and not expr_is_trivial(node, ctxt, safe_only, allow_member, allow_index, allow_call=False):
+        if require_trivial and not expr_is_trivial(summary, safe_only, allow_member, allow_index, allow_call=False):
             return
     
     # when reordering local declarations, ensure we don't change which local wins out among identically-named locals
@@ -372,7 +411,7 @@ def minify_merge_assignments(prev, next, ctxt, safe_only):
 
     next.erase()
 
-def minify_code(ctxt, root, minify_opts):
+def minify_code(ctxt, root, minify_opts, analysis=None):
     safe_reorder = minify_opts.get("safe-reorder", False)
     minify_lines = minify_opts.get("lines", True)
     minify_wspace = minify_opts.get("wspace", True)
@@ -384,7 +423,9 @@ def minify_code(ctxt, root, minify_opts):
     if not focus.tokens:
         safe_reorder = True # nothing gained with False here, so set it to True just in case.
 
-    analysis = analyze_code_for_minify(root, focus)
+    if analysis is None: # (else, was done via get_minify_analyzer during an earlier walk)
+        analysis = analyze_code_for_minify(root, focus)
+    summaries = {} # node -> NodeSummary, computed on demand (moved expressions keep theirs, as they don't change)
 
     def fixup_nodes_pre(node):
         if minify_tokens:
@@ -409,7 +450,7 @@ def minify_code(ctxt, root, minify_opts):
                 while prev and prev.type == None: # skip erased
                     prev = prev.prev_sibling()
                 if prev and prev.type == node.type:
-                    minify_merge_assignments(prev, node, ctxt, safe_reorder)
+                    minify_merge_assignments(prev, node, ctxt, safe_reorder, summaries)
           
     def remove_parens(token):
         token.erase("(")
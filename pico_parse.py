@@ -1,6 +1,7 @@
 from utils import *
 from pico_tokenize import TokenNodeBase, Token, TokenType
 from pico_tokenize import is_identifier, parse_string_literal, k_identifier_split_re
+from pico_preprocess import k_tab_break
 
 k_invalid = object()
 
@@ -51,11 +52,12 @@ class Scope:
         m.items[var.name] = var
 
     def find(m, name):
-        var = m.items.get(name)
-        if var:
-            return var
-        elif m.parent:
-            return m.parent.find(name)
+        curr = m
+        while curr:
+            var = curr.items.get(name)
+            if var:
+                return var
+            curr = curr.parent
     
     def chain(m):
         curr = m
@@ -63,6 +65,8 @@ class Scope:
             yield curr
             curr = curr.parent
     
+    # the used_* sets below are only filled by sublanguages - uses in parsed code are tracked by ScopeUses
+
     @lazy_property
     def used_locals(m): # set of Local or Label objs
         return set()
@@ -95,11 +99,12 @@ class LabelScope:
         m.labels[var.name] = var
     
     def find(m, name, crossfunc=False):
-        var = m.labels.get(name) if m.labels else None
-        if var:
-            return var
-        elif m.parent and (crossfunc or m.parent.funcdepth == m.funcdepth):
-            return m.parent.find(name)
+        curr = m
+        while curr:
+            var = curr.labels.get(name) if curr.labels else None
+            if var:
+                return var
+            curr = curr.parent if curr.parent and (crossfunc or curr.parent.funcdepth == curr.funcdepth) else None
     
     def chain(m, crossfunc=False):
         curr = m
@@ -123,6 +128,112 @@ class LabelScope:
     def has_used_members(m):
         return False
 
+class ScopeUses:
+    """Tracks the scopes (or label scopes) where variables are used, answering whether a variable
+    is used anywhere within a scope (including its descendants) without walking scope chains.
+    Call finish() after adding all uses and before querying."""
+
+    def __init__(m):
+        m.parents = {}
+        m.local_uses = defaultdict(list) # Local or Label -> scopes (sorted ranks after finish)
+        m.global_uses = defaultdict(list) # name -> scopes (ditto)
+        m.member_uses = defaultdict(list) # name -> scopes (ditto) - only for members used as if they were globals
+        m.scopes = m.ranks = m.ends = None
+
+    def add_scope(m, scope):
+        while scope not in m.parents:
+            m.parents[scope] = scope.parent
+            if scope.parent is None:
+                break
+            scope = scope.parent
+
+    def add_local_use(m, var, scope):
+        m.add_scope(var.scope)
+        m.add_scope(scope)
+        m.local_uses[var].append(scope)
+
+    def add_global_use(m, name, scope):
+        m.add_scope(scope)
+        m.global_uses[name].append(scope)
+
+    def add_member_use(m, name, scope):
+        m.add_scope(scope)
+        m.member_uses[name].append(scope)
+
+    def finish(m):
+        # number the scopes in preorder, so each scope's descendants are numbered [ranks[scope], ends[scope])
+        children = defaultdict(list)
+        roots = []
+        for scope, parent in m.parents.items():
+            if parent is None:
+                roots.append(scope)
+            else:
+                children[parent].append(scope)
+
+        m.scopes, m.ranks, m.ends = [], {}, {}
+        stack = [(root, False) for root in roots]
+        while stack:
+            scope, done = stack.pop()
+            if done:
+                m.ends[scope] = len(m.scopes)
+            else:
+                m.ranks[scope] = len(m.scopes)
+                m.scopes.append(scope)
+                stack.append((scope, True))
+                stack.extend((child, False) for child in children[scope])
+
+        for uses in (m.local_uses, m.global_uses, m.member_uses):
+            for key, scopes in uses.items():
+                uses[key] = sorted(m.ranks[scope] for scope in scopes)
+
+    def has_scope(m, scope):
+        return scope in m.ranks
+
+    def _get_scopes_using(m, ranks, top):
+        seen = set()
+        for rank in ranks:
+            scope = m.scopes[rank]
+            while scope is not None and scope not in seen:
+                seen.add(scope)
+                yield scope
+                if scope is top:
+                    break
+                scope = m.parents[scope]
+
+    def get_scopes_using_local(m, var):
+        """Yield the scopes that 'var' is used within (which are all within the var's scope)"""
+        start, end = m.ranks[var.scope], m.ends[var.scope]
+        return m._get_scopes_using((rank for rank in m.local_uses.get(var, ()) if start <= rank < end), var.scope)
+
+    def get_scopes_using_global(m, name):
+        return m._get_scopes_using(m.global_uses.get(name, ()), None)
+
+    def get_scopes_using_member(m, name):
+        return m._get_scopes_using(m.member_uses.get(name, ()), None)
+
+    def _is_used_within(m, ranks, scope):
+        rank = m.ranks[scope]
+        i = bisect.bisect_left(ranks, rank)
+        return i < len(ranks) and ranks[i] < m.ends[scope]
+
+    def is_local_used(m, var, scope):
+        """Is 'var' used within 'scope'? (which it can only be if 'scope' is within the var's scope)"""
+        if scope not in m.ranks: # e.g. a sublanguage's scope, which specifies its uses directly
+            return lazy_property.is_set(scope, "used_locals") and var in scope.used_locals
+        if var not in m.local_uses or not (m.ranks[var.scope] <= m.ranks[scope] < m.ends[var.scope]):
+            return False
+        return m._is_used_within(m.local_uses[var], scope)
+
+    def is_global_used(m, name, scope):
+        if scope not in m.ranks:
+            return scope.has_used_globals and name in scope.used_globals
+        return name in m.global_uses and m._is_used_within(m.global_uses[name], scope)
+
+    def is_member_used(m, name, scope):
+        if scope not in m.ranks:
+            return scope.has_used_members and name in scope.used_members
+        return name in m.member_uses and m._is_used_within(m.member_uses[name], scope)
+
 class NodeType(Enum):
     var = index = member = const = group = unary_op = binary_op = call = ...
     table = table_index = table_member = varargs = assign = op_assign = ...
@@ -141,8 +252,8 @@ class Node(TokenNodeBase):
         m.type, m.children = type, children
         m.__dict__.update(kwargs)
 
-        for child in children:
-            child.parent = m
+        for i, child in enumerate(children):
+            child.parent, child.child_i = m, i
     
     def get_tokens(m):
         tokens = []
@@ -174,13 +285,18 @@ class Node(TokenNodeBase):
             else:
                 return Token.synthetic(type, value, m.prev_token(), append=True)
 
+    def _reindex_children(m, start):
+        children = m.children
+        for i in range(start, len(children)):
+            children[i].parent, children[i].child_i = m, i
+
     def insert_token(m, i, type, value, near_next=False):
         m.children.insert(i, m._create_for_insert(i, type, value, near_next))
-        m.children[i].parent = m
+        m._reindex_children(i)
 
     def append_token(m, type, value, near_next=False):
         m.children.append(m._create_for_insert(len(m.children), type, value, near_next))
-        m.children[-1].parent = m
+        m._reindex_children(len(m.children) - 1)
 
     def erase_token(m, i, expected=None):
         m.children[i].erase(expected)
@@ -193,15 +309,15 @@ class Node(TokenNodeBase):
 
         existing.traverse_tokens(reset_location)
         m.children.insert(i, existing)
-        m.children[i].parent = m
+        m._reindex_children(i)
 
     def erase_child(m, i):
         m.children[i].erase()
 
     def replace_with(m, target): # target must not reference m, but may reference copy(m)
-        old_parent = m.parent
+        old_parent, old_child_i = m.parent, m.child_i
         m.__dict__ = target.__dict__
-        m.parent = old_parent
+        m.parent, m.child_i = old_parent, old_child_i
     
     def erase(m):
         m.replace_with(Node(None, []))
@@ -232,22 +348,57 @@ k_right_binary_ops = {
 
 k_block_ends = ("end", "else", "elseif", "until")
 
-def parse(source, tokens, ctxt=None):
+def parse(source, tokens, ctxt=None, segment=None):
+    """Parse 'tokens' into a syntax tree, returning it and a list of errors.
+    If 'segment' (a ParseSegment) is given, 'tokens' are instead parsed as part of the root block,
+    continuing from the segment's scope, and the segment receives the results (see IncrementalParser)"""
     idx = 0
     depth = -1 # incremented in parse_block
     funcdepth = -1 # incremented in parse_root
-    scope = Scope(None, depth, funcdepth)
+    base_scope = Scope(None, depth, funcdepth)
+    scope = None
     labelscope = LabelScope(None, funcdepth)
     unresolved_labels = None
     errors = []
     globals = LazyDict(lambda key: Global(key))
     members = LazyDict(lambda key: Member(key))
+
+    # instead of searching the scope chain, the locals visible from the current scope
+    # are kept in a stack per name, updated as scopes are entered and exited.
+    visible = defaultdict(list)
+    active = set()
+
+    def set_scope(new):
+        nonlocal scope
+        entered = []
+        common = new
+        while common and common not in active:
+            entered.append(common)
+            common = common.parent
+        
+        while scope is not common:
+            active.remove(scope)
+            for name in scope.items:
+                visible[name].pop()
+            scope = scope.parent
+        
+        for curr in reversed(entered):
+            active.add(curr)
+            for name, var in curr.items.items():
+                visible[name].append(var)
+        scope = new
+
+    def find_local(name):
+        stack = visible.get(name)
+        return stack[-1] if stack else None
     
-    scope.add(Local("_ENV", scope))
+    base_scope.add(Local("_ENV", base_scope))
 
     if ctxt and ctxt.local_builtins:
         for local in ctxt.local_builtins:
-            scope.add(Local(local, scope, builtin=True))
+            base_scope.add(Local(local, base_scope, builtin=True))
+    
+    set_scope(segment.scope if segment and segment.scope else base_scope)
    
     def peek(off=0):
         i = idx + off
@@ -317,7 +468,7 @@ def parse(source, tokens, ctxt=None):
                 assert isinstance(new, Scope)
                 var = Local(name, new)
             else:
-                var = scope.find(name)
+                var = find_local(name)
                 if var and var.scope.funcdepth != scope.funcdepth:
                     var.captured = True
             
@@ -349,7 +500,7 @@ def parse(source, tokens, ctxt=None):
         return node
     
     def parse_function(stmt=False, local=False):
-        nonlocal scope, funcdepth, unresolved_labels
+        nonlocal funcdepth, unresolved_labels
         if local:
             tokens = [peek(-2), peek(-1)]
         else:
@@ -357,17 +508,16 @@ def parse(source, tokens, ctxt=None):
         self_param = None
         func_kind = getattr(tokens[0], "func_kind", None)
 
-        if local:
-            scope = Scope(scope, depth, funcdepth)
+        localscope = Scope(scope, depth, funcdepth) if local else scope
         
         target, name = None, None
-        funcscope = Scope(scope, depth + 1, funcdepth + 1)
+        funcscope = Scope(localscope, depth + 1, funcdepth + 1)
 
         params = []
         if stmt:
             if local:
-                target = parse_var(new=scope)
-                scope.add(target.var)
+                target = parse_var(new=localscope)
+                localscope.add(target.var) # (entered together with funcscope below)
                 name = target.name
                 
             else:
@@ -415,11 +565,11 @@ def parse(source, tokens, ctxt=None):
         unresolved_labels = None
 
         funcdepth += 1
-        scope = funcscope
+        set_scope(funcscope)
         body = parse_block()
         tokens.append(body)
         require("end", tokens)
-        scope = scope.parent
+        set_scope(localscope)
         funcdepth -= 1
         
         late_resolve_labels()
@@ -655,7 +805,6 @@ def parse(source, tokens, ctxt=None):
         return Node(NodeType.until, tokens, cond=cond)
         
     def parse_for():
-        nonlocal scope
         tokens = [peek(-1)]
 
         if peek(1).value == "=":
@@ -676,11 +825,11 @@ def parse(source, tokens, ctxt=None):
             require("do", tokens)
             newscope.add(target.var)
 
-            scope = newscope
+            set_scope(newscope)
             body = parse_block()
             tokens.append(body)
             require("end", tokens)
-            scope = scope.parent
+            set_scope(newscope.parent)
 
             return Node(NodeType.for_, tokens, target=target, min=min, max=max, step=step, body=body)
 
@@ -694,11 +843,11 @@ def parse(source, tokens, ctxt=None):
             for target in targets:
                 newscope.add(target.var)
 
-            scope = newscope
+            set_scope(newscope)
             body = parse_block()
             tokens.append(body)
             require("end", tokens)
-            scope = scope.parent
+            set_scope(newscope.parent)
 
             return Node(NodeType.for_in, tokens, targets=targets, sources=sources, body=body)
 
@@ -721,7 +870,6 @@ def parse(source, tokens, ctxt=None):
         return node
 
     def parse_local():
-        nonlocal scope
         tokens = [peek(-1)]
         newscope = Scope(scope, depth, funcdepth)
 
@@ -732,7 +880,7 @@ def parse(source, tokens, ctxt=None):
             
         for target in targets:
             newscope.add(target.var)
-        scope = newscope
+        set_scope(newscope)
 
         return Node(NodeType.local, tokens, targets=targets, sources=sources)
 
@@ -816,14 +964,7 @@ def parse(source, tokens, ctxt=None):
         else:
             return parse_misc_stmt()
 
-    def parse_block(vline=None, with_until=False):
-        nonlocal scope, labelscope, depth
-        oldscope = scope
-        labelscope = LabelScope(labelscope, funcdepth)
-        depth += 1
-
-        stmts = []
-        tokens = []
+    def parse_stmts(vline, stmts, tokens):
         while e(peek().type):
             if e(vline) and peek().vline > vline:
                 break
@@ -838,13 +979,22 @@ def parse(source, tokens, ctxt=None):
             else:
                 tokens.append(peek(-1))
 
+    def parse_block(vline=None, with_until=False):
+        nonlocal labelscope, depth
+        oldscope = scope
+        labelscope = LabelScope(labelscope, funcdepth)
+        depth += 1
+
+        stmts = []
+        tokens = []
+        parse_stmts(vline, stmts, tokens)
+
         if with_until:
             until = parse_until()
 
         depth -= 1
         labelscope = labelscope.parent
-        while scope != oldscope:
-            scope = scope.parent
+        set_scope(oldscope)
         
         node = Node(NodeType.block, tokens, stmts=stmts)
         if with_until:
@@ -878,6 +1028,26 @@ def parse(source, tokens, ctxt=None):
         #verify_parse(root) # DEBUG
         return root
 
+    def parse_segment():
+        nonlocal funcdepth, depth, labelscope
+        funcdepth += 1
+        depth += 1
+        labelscope = LabelScope(labelscope, funcdepth)
+
+        stmts = []
+        children = []
+        parse_stmts(None, stmts, children)
+
+        if peek().type != None:
+            add_error("Expected end of input")
+        if idx < len(tokens):
+            children.append(take()) # extra comments/etc
+
+        segment.stmts, segment.children = stmts, children
+        segment.scope, segment.labelscope, segment.unresolved_labels = scope, labelscope, unresolved_labels
+        segment.globals, segment.members = globals, members
+        return segment
+
     def verify_parse(root):
         def visitor(token):
             nonlocal idx
@@ -890,10 +1060,253 @@ def parse(source, tokens, ctxt=None):
         assert idx == len(tokens)
 
     try:
-        return parse_root(), errors
+        return parse_segment() if segment else parse_root(), errors
     except ParseError:
         return None, errors
 
+class ParseSegment:
+    """A part of the root block (typically, a tab) that was parsed separately by IncrementalParser"""
+    def __init__(m, text, start, tokens, names, scope=None):
+        m.text, m.start, m.tokens = text, start, tokens
+        m.names = names # names (& funcdepths) of the locals visible at the start of the segment, or None if it's the first
+        m.scope = scope # scope to continue parsing from; once parsed - the scope at the end of the segment
+        m.ok = False
+
+def get_visible_locals(scope):
+    visible = {}
+    for curr in scope.chain():
+        for name, var in curr.items.items():
+            visible.setdefault(name, var)
+    return visible
+
+def merge_var_flags(var, other):
+    var.implicit = var.implicit or other.implicit
+    var.reassigned = var.reassigned or other.reassigned
+    if isinstance(var, Local):
+        var.captured = var.captured or other.captured
+    for key in ("keys_kind", "rename"):
+        if key in other.__dict__:
+            setattr(var, key, other.__dict__[key])
+
+class IncrementalParser:
+    """Parses successive versions of the same code (e.g. a cart being edited), re-parsing only the tabs that changed.
+    The syntax trees of the other tabs are kept and re-linked with the re-parsed ones (globals, members, top-level locals & scopes).
+    Falls back to a full parse when the tabs can't be parsed separately (e.g. a function spanning tabs, or top-level labels).
+    The returned tree is reused by the next parse, so it mustn't be modified (as rename/minify do) - it's meant for lint/count"""
+
+    def __init__(m, ctxt=None):
+        m.ctxt = ctxt
+        m.segments = []
+
+    def parse(m, source, tokens):
+        """Like parse(source, tokens, ctxt). Reused tokens are put in 'tokens' in place of the new ones"""
+        splits = m.split(source.text, tokens)
+        if len(splits) == 1:
+            m.segments = []
+            return parse(source, tokens, m.ctxt)
+
+        old_segments = defaultdict(list)
+        for seg in m.segments:
+            old_segments[seg.text].append(seg)
+
+        m.segments = []
+        scope = None
+        for start, end, token_i, token_end_i in splits:
+            text = source.text[start:end]
+            seg_tokens = tokens[token_i:token_end_i]
+            names = frozenset((name, var.scope.funcdepth) for name, var in get_visible_locals(scope).items()) if scope else None
+
+            seg = m.reuse(old_segments.get(text), names, start, seg_tokens)
+            if seg and seg.ok:
+                tokens[token_i:token_end_i] = seg.tokens
+            elif not seg:
+                seg = m.parse_segment(source, text, start, seg_tokens, names)
+
+            m.segments.append(seg)
+            if not seg.ok:
+                return parse(source, tokens, m.ctxt)
+            
+            scope = m.link_segment(seg, scope)
+        
+        return m.link_root(), []
+
+    @staticmethod
+    def split(text, tokens):
+        """Split text & tokens into segments at tab breaks - at least where the code on both sides can be parsed separately"""
+        splits = []
+        start = token_i = 0
+        end = text.find(k_tab_break)
+        while end >= 0:
+            end += 1 # (start next tab at the '-->8' comment)
+            end_i = token_i
+            while end_i < len(tokens) and tokens[end_i].idx < end:
+                end_i += 1
+
+            if (end_i == 0 or tokens[end_i - 1].endidx <= end) and \
+               (end_i == len(tokens) or tokens[end_i].value != "("): # (else, may continue a call on the previous tab)
+                splits.append((start, end, token_i, end_i))
+                start, token_i = end, end_i
+
+            end = text.find(k_tab_break, end)
+
+        splits.append((start, len(text), token_i, len(tokens)))
+        return splits
+
+    @staticmethod
+    def reuse(old_segments, names, start, tokens):
+        """Return an old segment matching the given new one, after updating it to the new one's location"""
+        def get_hints(token):
+            return {key: val for key, val in token.__dict__.items() if key != "sublang"}
+
+        for seg in old_segments or ():
+            # (the text is the same, but comments at the end of the previous tab may still affect the first token)
+            if seg.names == names and len(seg.tokens) == len(tokens) and \
+               (not tokens or (tokens[0].idx - start == seg.tokens[0].idx - seg.start and get_hints(tokens[0]) == get_hints(seg.tokens[0]))):
+                old_segments.remove(seg)
+                break
+        else:
+            return None
+
+        if seg.ok:
+            delta = start - seg.start
+            vdelta = tokens[0].vline - seg.tokens[0].vline if tokens else 0
+            if delta or vdelta:
+                for token in seg.all_tokens:
+                    token.idx += delta
+                    token.endidx += delta
+                    if e(token.vline):
+                        token.vline += vdelta
+            
+            for token, new_token in zip(seg.tokens, tokens):
+                token.children = new_token.children
+                for comment in token.children:
+                    comment.parent = token
+        else:
+            seg.tokens = tokens
+        
+        seg.start = start
+        return seg
+
+    def parse_segment(m, source, text, start, tokens, names):
+        if names is None:
+            seg = ParseSegment(text, start, tokens, names)
+        else:
+            # proxies for the visible locals, replaced with the real ones when linking
+            base_scope = Scope(None, -1, -1)
+            top_scope = Scope(base_scope, 0, 0)
+            for name, funcdepth in names:
+                proxy_scope = base_scope if funcdepth < 0 else top_scope
+                proxy_scope.add(Local(name, proxy_scope))
+            # (until the first top-level local, the root block is parsed in the base scope)
+            start_scope = top_scope if top_scope.items else base_scope
+            seg = ParseSegment(text, start, tokens, names, start_scope)
+
+        _, errors = parse(source, tokens, m.ctxt, segment=seg)
+        seg.ok = not errors and not seg.labelscope.labels and not seg.unresolved_labels # (labels may be used across tabs)
+        if seg.ok:
+            m.index_segment(seg, () if names is None else (base_scope, top_scope), None if names is None else start_scope)
+        return seg
+
+    @staticmethod
+    def index_segment(seg, proxy_scopes, start_scope):
+        """Collect what needs updating in the segment when it's moved or linked"""
+        seg.all_tokens = []
+        seg.global_nodes, seg.member_nodes, seg.outer_nodes, seg.boundary_nodes = [], [], [], []
+        seg.top_scopes, seg.top_labelscopes = [], []
+        own_locals = []
+        seen_scopes = set(proxy_scopes)
+        seen_labelscopes = {seg.labelscope}
+
+        def add_scope(scope, seen, top_scopes, top_scope):
+            while scope not in seen:
+                seen.add(scope)
+                if scope.parent is top_scope:
+                    top_scopes.append(scope)
+                    break
+                scope = scope.parent
+
+        def visit_node(node):
+            if node.type == NodeType.var:
+                if node.kind == VarKind.global_:
+                    seg.global_nodes.append(node)
+                elif node.kind == VarKind.member:
+                    seg.member_nodes.append(node)
+                elif node.kind == VarKind.local:
+                    if node.new:
+                        own_locals.append(node.var)
+                    elif node.var.scope in proxy_scopes:
+                        seg.outer_nodes.append((node, node.var))
+                    add_scope(node.var.scope, seen_scopes, seg.top_scopes, start_scope)
+                
+                if node.kind == VarKind.label:
+                    add_scope(node.scope, seen_labelscopes, seg.top_labelscopes, seg.labelscope)
+                elif node.scope and node.scope in proxy_scopes:
+                    seg.boundary_nodes.append(node)
+                elif node.scope:
+                    add_scope(node.scope, seen_scopes, seg.top_scopes, start_scope)
+
+        for child in seg.children:
+            if isinstance(child, Node):
+                child.traverse_nodes(visit_node, tokens=seg.all_tokens.append, extra=True)
+            else:
+                seg.all_tokens.append(child)
+        
+        if not proxy_scopes: # first segment - owns _ENV & the builtin locals
+            own_locals += list(seg.scope.chain())[-1].items.values()
+
+        seg.own_locals = [(var, var.__dict__.copy()) for var in own_locals]
+        seg.proxies = list(dict.fromkeys(var for _, var in seg.outer_nodes))
+        seg.start_scope = start_scope
+
+    @staticmethod
+    def link_segment(seg, scope):
+        """Link the segment's top-level scopes & locals to 'scope' - the scope at the end of the previous segment.
+        Returns the scope at the end of the segment"""
+        for var, attrs in seg.own_locals:
+            var.__dict__ = attrs.copy() # (undo merges from previous links)
+
+        if not scope:
+            return seg.scope
+        
+        visible = get_visible_locals(scope)
+        for proxy in seg.proxies:
+            merge_var_flags(visible[proxy.name], proxy)
+        for node, proxy in seg.outer_nodes:
+            node.var = visible[proxy.name]
+        for node in seg.boundary_nodes:
+            node.scope = scope
+        for top_scope in seg.top_scopes:
+            top_scope.parent = scope
+
+        return scope if seg.scope is seg.start_scope else seg.scope
+
+    def link_root(m):
+        """Link the segments' globals, members & top-level label scopes together, returning the root node"""
+        globals = LazyDict(lambda key: Global(key))
+        members = LazyDict(lambda key: Member(key))
+        root_labelscope = m.segments[0].labelscope
+        stmts, children = [], []
+
+        for seg in m.segments:
+            for name, var in seg.globals.items():
+                merge_var_flags(globals[name], var)
+            for name, var in seg.members.items():
+                merge_var_flags(members[name], var)
+            for node in seg.global_nodes:
+                node.var = globals[node.name]
+            for node in seg.member_nodes:
+                node.var = members[node.name]
+            for labelscope in seg.top_labelscopes:
+                labelscope.parent = root_labelscope
+            
+            stmts += seg.stmts
+            children += seg.children
+        
+        root = Node(NodeType.block, children, stmts=stmts)
+        root.globals = globals
+        root.members = members
+        return root
+
 # node utils
 
 def is_assign_target(node):
@@ -1,7 +1,9 @@
 from utils import *
 from pico_defs import from_p8str
-from pico_compress import print_size
+from pico_compress import print_size, compress_code
 from pico_preprocess import k_tab_break
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 # when adding new globals:
 #   check whether to update builtins_copied_to_locals (find 'local ...=...' script inside pico8 binary; e.g. `strings $(which pico8) | grep "^local "`)
@@ -58,30 +60,42 @@ builtins_with_callbacks = { # builtins listed here may call user code before ret
     "coresume", "foreach", "yield",
 }
 
-def get_line_col(text, idx, start=0): # (0-based)
-    line = 0
-
-    while start < idx:
-        end = text.find("\n", start)
-        if end < 0 or end >= idx:
-            break
-        line += 1
-        start = end + 1
-    
-    return line, idx - start
+class TextIndex:
+    """An index of where the lines (and tabs) of a text start, for quickly finding the line & column of an index"""
+    def __init__(m, text):
+        m.newlines = [match.start() for match in re.finditer("\n", text)]
+
+        m.tab_breaks = []
+        end = text.find(k_tab_break)
+        while end >= 0 and len(m.tab_breaks) < 15:
+            m.tab_breaks.append(end)
+            end = text.find(k_tab_break, end + len(k_tab_break))
+
+    def get_line_col(m, idx, start=0): # (0-based, relative to 'start')
+        if idx <= start:
+            return 0, idx - start
+
+        first = bisect.bisect_left(m.newlines, start)
+        last = bisect.bisect_left(m.newlines, idx, first)
+        if last > first:
+            start = m.newlines[last - 1] + 1
+        return last - first, idx - start
+
+    def get_tab_line_col(m, idx): # (0-based)
+        tab = bisect.bisect_left(m.tab_breaks, idx)
+        start = m.tab_breaks[tab - 1] + len(k_tab_break) if tab else 0
+        line, col = m.get_line_col(idx, start)
+        return tab, line, col
+
+@lru_cache(maxsize=64)
+def get_text_index(text):
+    return TextIndex(text)
 
-def get_tab_line_col(text, idx, start=0): # (0-based)
-    tab = 0
+def get_line_col(text, idx, start=0): # (0-based)
+    return get_text_index(text).get_line_col(idx, start)
 
-    while start < idx and tab < 15:
-        end = text.find(k_tab_break, start)
-        if end < 0 or end >= idx:
-            break
-        tab += 1
-        start = end + len(k_tab_break)
-    
-    line, col = get_line_col(text, idx, start)
-    return tab, line, col
+def get_tab_line_col(text, idx): # (0-based)
+    return get_text_index(text).get_tab_line_col(idx)
 
 class SourceLocation(Tuple):
     """A location in a source file (optionally with a tab)"""
@@ -111,11 +125,16 @@ class CartSource(PicoSource):
         m.mappings = cart.code_map
         # no __init__ - we override with properties
 
+    @lazy_property
+    def mapping_idxs(m): # (the mappings are ordered by idx)
+        return [mapping.idx for mapping in m.mappings]
+
     def get_location(m, idx, tabs=False):
-        for mapping in reversed(m.mappings):
-            if idx >= mapping.idx:
-                mapped_idx = mapping.src_idx + (idx - mapping.idx)
-                return get_source_location(mapping.src_path, mapping.src_code, mapped_idx, mapping.src_line, tabs=tabs)
+        i = bisect.bisect_right(m.mapping_idxs, idx)
+        if i:
+            mapping = m.mappings[i - 1]
+            mapped_idx = mapping.src_idx + (idx - mapping.idx)
+            return get_source_location(mapping.src_path, mapping.src_code, mapped_idx, mapping.src_line, tabs=tabs)
         
         return super().get_location(idx, tabs)
 
@@ -215,8 +234,71 @@ def fixup_process_args(args):
     args_set = isinstance(args, dict)
     return args_set, args
 
+def get_rename_variant_size(ctxt, path, text, all_comments, minify, rename, variant_i):
+    """rename & minify 'text' with the given index of k_rename_variants, returning the size of the result
+    according to the focus - as a tuple of the token count (if focusing on tokens), char count (if focusing on chars)
+    and compressed size"""
+    ctxt = copy(ctxt)
+    ctxt.srcmap = None # (only the chosen variant's renames are logged)
+    source = PicoSource(path, text)
+    tokens, _ = tokenize(source, ctxt, all_comments)
+    root, _ = parse(source, tokens, ctxt)
+    focus = Focus(minify.get("focus"))
+    analyzer, get_analysis = get_minify_analyzer(focus)
+    rename_tokens(ctxt, root, rename, k_rename_variants[variant_i], visitors=(analyzer,))
+    new_text = minify_code(ctxt, root, minify, get_analysis())
+
+    size = []
+    if focus.tokens:
+        size.append(count_tokens(root.get_tokens()))
+    if focus.chars:
+        size.append(len(new_text))
+    
+    w = BinaryWriter()
+    compress_code(w, new_text, force_compress=True, fail_on_error=False)
+    size.append(len(w.f.getvalue()))
+    return tuple(size)
+
+def find_best_rename_variant(ctxt, source, all_comments, minify, rename):
+    """try the first 'effort' rename variants in parallel (in batches, until the 'effort-time' budget - if any - runs out),
+    returning the index of the one giving the smallest size per the focus (see get_rename_variant_size)"""
+    variant_idxs = range(min(rename["effort"], len(k_rename_variants)))
+    time_budget = rename.get("effort-time")
+    args = (ctxt, source.path, source.text, all_comments, minify, rename)
+
+    pool = None
+    if not ctxt.sublang_getter: # (may come from a script, so can't be passed to other processes)
+        try:
+            pool = ProcessPoolExecutor(min(len(variant_idxs), os.cpu_count() or 1))
+        except (OSError, ImportError, NotImplementedError):
+            pass
+    batch_size = min(len(variant_idxs), os.cpu_count() or 1) if pool else 1
+    
+    def measure(batch):
+        nonlocal pool
+        if pool:
+            try:
+                return list(pool.map(get_rename_variant_size, *map(itertools.repeat, args), batch))
+            except BrokenProcessPool:
+                pool = None
+        return [get_rename_variant_size(*args, i) for i in batch] # no multiprocessing
+
+    sizes = {}
+    start_time = time.time()
+    try:
+        for batch_start in range(0, len(variant_idxs), batch_size):
+            if sizes and e(time_budget) and time.time() - start_time >= time_budget:
+                break
+            batch = variant_idxs[batch_start:batch_start + batch_size]
+            sizes.update(zip(batch, measure(batch)))
+    finally:
+        if pool:
+            pool.shutdown()
+
+    return min(sizes, key=lambda i: sizes[i]) # (ties go to the first)
+
 def process_code(ctxt, source, input_count=False, count=False, lint=False, minify=False, rename=False, unminify=False, 
-                 stop_on_lint=True, fail=True, want_count=True):
+                 stop_on_lint=True, fail=True, want_count=True, timings=None, parser=None):
     need_lint, lint = fixup_process_args(lint)
     need_minify, minify = fixup_process_args(minify)
     need_rename, rename = fixup_process_args(rename)
@@ -228,34 +310,63 @@ def process_code(ctxt, source, input_count=False, count=False, lint=False, minif
     need_parse = need_lint or need_minify or need_unminify
     need_all_comments = need_unminify or (need_minify and minify_needs_comments(minify))
 
+    if not need_parse: # just counting - try doing it without tokenizing
+        with timed_stage(timings, "count"):
+            num_tokens = count_tokens_fast(source.text, ctxt)
+        if e(num_tokens):
+            if input_count:
+                print_token_count(num_tokens, prefix="input", handler=input_count)
+            if count:
+                print_token_count(num_tokens, handler=count)
+            return True, ()
+
     ok = False
-    tokens, errors = tokenize(source, ctxt, need_all_comments)
+    if need_minify or need_unminify:
+        parser = None # (they modify the tree, while an IncrementalParser reuses it)
+    
+    with timed_stage(timings, "tokenize"):
+        tokens, errors = tokenize(source, ctxt, need_all_comments)
     if not errors and need_parse:
-        root, errors = parse(source, tokens, ctxt)
+        with timed_stage(timings, "parse"):
+            root, errors = parser.parse(source, tokens) if parser else parse(source, tokens, ctxt)
     
     new_text = None
     if not errors:
         ok = True
 
         if input_count:
-            print_token_count(count_tokens(tokens), prefix="input", handler=input_count)
+            with timed_stage(timings, "count"):
+                print_token_count(count_tokens(tokens), prefix="input", handler=input_count)
 
         if need_lint:
-            errors = lint_code(ctxt, root, lint)
+            with timed_stage(timings, "lint"):
+                errors = lint_code(ctxt, root, lint)
         
         if not errors or not stop_on_lint:        
             if need_minify:
+                analysis = None
                 if need_rename:
-                    rename_tokens(ctxt, root, rename)
-
-                new_text = minify_code(ctxt, root, minify)
+                    variant = None
+                    if rename.get("effort", 1) > 1:
+                        with timed_stage(timings, "rename search"):
+                            variant = k_rename_variants[find_best_rename_variant(ctxt, source, need_all_comments, minify, rename)]
+
+                    with timed_stage(timings, "rename"): # (also analyzes the code for minify_code, in the same walk)
+                        analyzer, get_analysis = get_minify_analyzer(Focus(minify.get("focus")))
+                        rename_tokens(ctxt, root, rename, variant, visitors=(analyzer,))
+                        analysis = get_analysis()
+
+                with timed_stage(timings, "minify"):
+                    new_text = minify_code(ctxt, root, minify, analysis)
             
             if need_unminify:
-                new_text = unminify_code(root, unminify)
+                with timed_stage(timings, "unminify"):
+                    new_text = unminify_code(root, unminify)
 
             if count:
-                new_tokens = root.get_tokens() if need_parse else tokens
-                print_token_count(count_tokens(new_tokens), handler=count)
+                with timed_stage(timings, "count"):
+                    new_tokens = root.get_tokens() if need_parse else tokens
+                    print_token_count(count_tokens(new_tokens), handler=count)
 
     if fail and errors:
         throw("\n".join(map(str, errors)))
@@ -273,14 +384,14 @@ def echo_code(code, echo=True):
     else:
         file_write_text(echo, code)    
 
-from pico_tokenize import tokenize, count_tokens
+from pico_tokenize import tokenize, count_tokens, count_tokens_fast
 from pico_parse import parse
 from pico_lint import lint_code
-from pico_minify import minify_code, minify_needs_comments
+from pico_minify import minify_code, minify_needs_comments, get_minify_analyzer, Focus
 from pico_unminify import unminify_code
-from pico_rename import rename_tokens
+from pico_rename import rename_tokens, k_rename_variants
 
 # re-export some things for examples/etc.
 from pico_tokenize import is_identifier, is_ident_char
-from pico_parse import Local, Global, Scope
+from pico_parse import Local, Global, Scope, IncrementalParser
 from pico_preprocess import CustomPreprocessor
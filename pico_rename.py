@@ -1,7 +1,7 @@
 from utils import *
-from pico_defs import from_p8str
-from pico_tokenize import TokenType, Token, is_identifier, keywords, CommentHint
-from pico_parse import VarKind, NodeType, VarBase
+from pico_defs import from_p8str, to_p8str
+from pico_tokenize import TokenType, Token, TraverseVisitor, is_identifier, keywords, CommentHint
+from pico_parse import VarKind, NodeType, VarBase, ScopeUses
 from pico_minify import format_string_literal, Focus
 import fnmatch
 
@@ -96,7 +96,112 @@ class TableMemberPairIncludeExcludeMapping:
         
         return bool(value)
 
-def rename_tokens(ctxt, root, rename_opts):
+class RenameVariant(Tuple):
+    """Tuning parameters of how new identifiers are chosen"""
+    char_order = "uses" # "uses" - identifier chars that appear in the code more often go first, "fixed" - the default order
+    char_set = None # "lowercase" or "letters" (each also with digits & underscore), or None to choose by focus
+    swap_kinds = False # whether to reverse the order in which locals and globals/members are assigned, from the focus's default
+
+# the variants tried by the rename 'effort' option, in order (the first is the default, the rest - by usefulness)
+k_rename_variants = (
+    RenameVariant(),
+    RenameVariant(char_order="fixed"),
+    RenameVariant(swap_kinds=True),
+    RenameVariant(char_order="fixed", swap_kinds=True),
+    RenameVariant(char_set="letters"),
+    RenameVariant(char_set="lowercase"),
+    RenameVariant(char_order="fixed", char_set="letters"),
+    RenameVariant(char_order="fixed", char_set="lowercase"),
+)
+
+class IndexSet(set):
+    """A set of indices that tracks the first index missing from it"""
+    first_free = 0
+
+    def add(m, i):
+        super().add(i)
+        while m.first_free in m:
+            m.first_free += 1
+
+class IdentSequence:
+    """The sequence of new identifiers, in the ideal order given by 'ident_chars' (most preferred first).
+    Generated on demand, one block of identifiers (differing only in their last char) at a time"""
+
+    def __init__(m, ident_chars):
+        m.chars = ident_chars
+        m.first_chars = [ch for ch in ident_chars if not ch.isdigit()]
+        m.idents = []
+        m.prefix = None # digits of the prefix of the next block, as indices into first_chars (for the first digit) or chars
+
+    def _add_block(m):
+        if m.prefix is None:
+            block = m.first_chars
+            m.prefix = [0]
+        else:
+            prefix = m.first_chars[m.prefix[0]] + "".join(m.chars[digit] for digit in m.prefix[1:])
+            block = [prefix + ch for ch in m.chars]
+            
+            for i in range(len(m.prefix) - 1, -1, -1):
+                m.prefix[i] += 1
+                if m.prefix[i] < len(m.first_chars if i == 0 else m.chars):
+                    break
+                m.prefix[i] = 0
+            else:
+                m.prefix.append(0)
+
+        m.idents.extend(ident for ident in block if ident not in keywords)
+
+    def __getitem__(m, i):
+        while i >= len(m.idents):
+            m._add_block()
+        return m.idents[i]
+
+    def _raw_index(m, ident):
+        """The index of 'ident' in the sequence if keywords weren't skipped (or None if it's not in the sequence)"""
+        if not ident or ident[0] not in m.first_chars or any(ch not in m.chars for ch in ident):
+            return None
+
+        index = m.first_chars.index(ident[0])
+        block_size = len(m.first_chars)
+        for ch in ident[1:]:
+            index = index * len(m.chars) + m.chars.index(ch)
+            block_size *= len(m.chars)
+        return index + (block_size - len(m.first_chars)) // (len(m.chars) - 1) # (+ count of shorter identifiers)
+
+    @lazy_property
+    def keyword_raw_indices(m):
+        return sorted(index for index in map(m._raw_index, keywords) if e(index))
+
+    def index(m, ident):
+        """The index of 'ident' in the sequence, or None if it's not in it.
+        Computed directly, so it works even for identifiers not yet generated"""
+        index = m._raw_index(ident)
+        if index is None or ident in keywords:
+            return None
+        return index - bisect.bisect_left(m.keyword_raw_indices, index)
+
+@lru_cache(maxsize=8)
+def get_ident_sequence(ident_chars):
+    return IdentSequence(ident_chars)
+
+k_rename_map_kinds = {str(kind): kind for kind in (VarKind.local, VarKind.global_, VarKind.member, VarKind.label)}
+
+def parse_rename_map(text):
+    """Parse a rename map (as logged via ctxt.srcmap) into {kind: {old name: [new names]}}"""
+    prev_renames = defaultdict(lambda: defaultdict(list))
+    for line in text.splitlines() if text else ():
+        kind, _, rest = line.strip().partition(" ")
+        new, sep, old = rest.partition(" <- ")
+        if kind in k_rename_map_kinds and sep and new and old:
+            prev_names = prev_renames[k_rename_map_kinds[kind]][to_p8str(old)]
+            new = to_p8str(new)
+            if new not in prev_names:
+                prev_names.append(new)
+    return prev_renames
+
+def rename_tokens(ctxt, root, rename_opts, variant=None, visitors=()):
+    """rename the identifiers in root. 'visitors' are TraverseVisitors that are independent of the renaming, to run
+    as part of its first walk over the tree (instead of as a separate walk)"""
     global_strings_cpy = ctxt.builtins | global_callbacks
     preserved_globals = IncludeExcludeMapping(global_strings_cpy)
     preserved_members = TableMemberPairIncludeExcludeMapping(members=member_strings)
@@ -122,13 +227,17 @@ def rename_tokens(ctxt, root, rename_opts):
     members_as_globals = False
     safe_only = rename_opts.get("safe-only", False)
     focus = Focus(rename_opts.get("focus"))
+    prev_renames = parse_rename_map(rename_opts.get("prev-map"))
+    variant = variant or k_rename_variants[0]
     for rule in rename_opts.get("rules", ()):
         add_rule(rule)
 
     # collect char histogram
     # (reusing commonly used chars in our new identifiers lowers compressed size)
     #
-    # also takes the opportunity to find global preserve hints in code
+    # also takes the opportunity to find global preserve hints in code,
+    # and - if requested - to detect which renames are safe to do (in the same walk)
+    # (note - this assumes a "pure" cart with no hints for shrinko8)
 
     char_uses = CounterDictionary()
     def collect_chars(token):
@@ -154,10 +263,28 @@ def rename_tokens(ctxt, root, rename_opts):
                 for ch in token.value:
                     char_uses[ch] += 1
 
-    root.traverse_tokens(collect_chars)
+    uses_env = False
+    def check_safety(node):
+        nonlocal uses_env
+        if node.type == NodeType.var and node.kind != VarKind.member and node.name == "_ENV":
+            uses_env = True
+
+    visitors = [TraverseVisitor(tokens=collect_chars), *visitors]
+    if safe_only:
+        visitors.append(TraverseVisitor(pre=check_safety))
+    root.traverse_nodes_multi(visitors)
+
+    if safe_only: # (applied after the walk, so it overrides any preserve hints)
+        preserved_members.default = True # can't reasonably guarantee safety of this
+        if uses_env:
+            preserved_globals.default = True
 
     # TODO: something must still be unoptimal with char_uses collection, as hardcoding k_identifier_chars is more helpful than going by uses...
-    if focus.chars:
+    if variant.char_set == "lowercase":
+        k_identifier_chars = string.ascii_lowercase + string.digits + "_"
+    elif variant.char_set == "letters":
+        k_identifier_chars = string.ascii_letters + string.digits + "_"
+    elif focus.chars:
         k_identifier_chars = string.ascii_letters + string.digits + "_\x1e\x1f" + "".join(chr(x) for x in range(0x80,0x100))
     elif focus.compressed:
         k_identifier_chars = string.ascii_lowercase + string.digits + "_"
@@ -165,27 +292,15 @@ def rename_tokens(ctxt, root, rename_opts):
         k_identifier_chars = string.ascii_letters + string.digits + "_"
     
     ident_chars = []
-    for ch in sorted(char_uses, key=lambda k: char_uses[k], reverse=True):
-        if ch in k_identifier_chars:
-            ident_chars.append(ch)
+    if variant.char_order == "uses":
+        for ch in sorted(char_uses, key=lambda k: char_uses[k], reverse=True):
+            if ch in k_identifier_chars:
+                ident_chars.append(ch)
     
     for ch in k_identifier_chars:
         if ch not in ident_chars:
             ident_chars.append(ch)
 
-    ident_char_order_map = {ch1: ch2 for ch1, ch2 in zip(ident_chars, ident_chars[1:])}
-
-    # detect which renames are safe to do, if requested
-    # (note - this assumes a "pure" cart with no hints for shrinko8)
-
-    if safe_only:
-        preserved_members.default = True # can't reasonably guarantee safety of this
-        
-        def check_safety(node):
-            if node.type == NodeType.var and node.kind != VarKind.member and node.name == "_ENV":
-                preserved_globals.default = True
-
-        root.traverse_nodes(check_safety)
 
     # collect uses of identifier
     # (e.g. to give priority to more frequently used ones)
@@ -205,14 +320,14 @@ def rename_tokens(ctxt, root, rename_opts):
     members_after_zero = set()
     locals_after_zero = set()
 
-    renamed_vars = set()
+    renamed_vars = {} # (used as an ordered set)
 
     def compute_effective_kind(node, kind, explicit):
         """get the identifier kind (global/member/etc) of a node, taking into account hints in the code"""
 
         if node.var.rename:
             node.name = node.var.rename
-            renamed_vars.add(node.var)
+            renamed_vars[node.var] = True
             if kind == VarKind.member:
                 member_excludes.add(node.name)
             elif kind == VarKind.global_:
@@ -310,17 +425,13 @@ def rename_tokens(ctxt, root, rename_opts):
                     
             # add to the scope based on real kind, as we need to avoid conflicts with preserved vars too
             if node.kind == VarKind.global_:
-                for scope in node.scope.chain():
-                    if node.effective_kind == VarKind.member: # rare, e.g. see --[[member-keys]] example
-                        scope.used_members.add(node.name)
-                    else:
-                        scope.used_globals.add(node.name)
+                if node.effective_kind == VarKind.member: # rare, e.g. see --[[member-keys]] example
+                    scope_uses.add_member_use(node.name, node.scope)
+                else:
+                    scope_uses.add_global_use(node.name, node.scope)
 
             elif node.kind in (VarKind.local, VarKind.label):
-                for scope in node.scope.chain():
-                    scope.used_locals.add(node.var)
-                    if scope == node.var.scope:
-                        break
+                scope_uses.add_local_use(node.var, node.scope)
                         
         elif node.type == NodeType.sublang:
             for name, count in node.lang.get_global_usages().items():
@@ -341,34 +452,12 @@ def rename_tokens(ctxt, root, rename_opts):
                 if not var.implicit:
                     local_uses[var] += count
 
+    scope_uses = ScopeUses()
     root.traverse_nodes(collect_idents_pre, extra=True)
+    scope_uses.finish()
 
     # assign new names to identifiers
 
-    def get_next_ident_char(ch, first):
-        nextch = ident_char_order_map.get(ch) if ch else ident_chars[0]
-        while first and nextch and nextch.isdigit():
-            nextch = ident_char_order_map.get(nextch)
-        if nextch:
-            return nextch, True
-        else:
-            return ident_chars[0], False
-
-    def get_idents():
-        """a generator of new identifiers, in the ideal order"""
-        next_ident = ""
-
-        while True:
-            for i in range(len(next_ident)-1, -1, -1):
-                next_ch, found = get_next_ident_char(next_ident[i], i==0)
-                next_ident = str_replace_at(next_ident, i, 1, next_ch)
-                if found:
-                    break
-            else:
-                next_ident = str_insert(next_ident, 0, get_next_ident_char(None, True)[0])
-            if next_ident not in keywords:
-                yield next_ident
-
     def are_vars_compatible(var1, var2):
         is_global1 = var1.kind in (VarKind.global_, VarKind.member)
         is_global2 = var2.kind in (VarKind.global_, VarKind.member)
@@ -381,86 +470,157 @@ def rename_tokens(ctxt, root, rename_opts):
             if lvar.kind == VarKind.label:
                 return True
             
-            if gvar.kind == VarKind.global_ and lvar.scope.has_used_globals and gvar.name in lvar.scope.used_globals:
+            if gvar.kind == VarKind.global_ and scope_uses.is_global_used(gvar.name, lvar.scope):
                 return False
-            if gvar.kind == VarKind.member and lvar.scope.has_used_members and gvar.name in lvar.scope.used_members:
+            if gvar.kind == VarKind.member and scope_uses.is_member_used(gvar.name, lvar.scope):
                 return False
             return True
 
         else: # both locals/labels
             if var1.kind == var2.kind:
-                return var1 not in var2.scope.used_locals and var2 not in var1.scope.used_locals
+                return not scope_uses.is_local_used(var1, var2.scope) and not scope_uses.is_local_used(var2, var1.scope)
             else:
                 return True
     
-    remaining_locals = list(sorted(local_uses, key=lambda k: local_uses[k], reverse=True))
-    remaining_globals = list(sorted(global_uses, key=lambda k: global_uses[k], reverse=True))
-    remaining_members = list(sorted(member_uses, key=lambda k: member_uses[k], reverse=True))
-    remaining_labels = list(sorted(label_uses, key=lambda k: label_uses[k], reverse=True))
+    # build the graph of conflicting variables - those that cannot be given the same identifier
+    # (variables from sublanguages may have uses unknown to scope_uses, so they're instead checked via are_vars_compatible)
+
+    scope_vars = defaultdict(list)
+    irregular_vars = set()
+    for var in itertools.chain(local_uses, label_uses):
+        if scope_uses.has_scope(var.scope):
+            scope_vars[var.scope].append(var)
+        else:
+            irregular_vars.add(var)
+
+    conflicts = defaultdict(set)
+    def add_conflicts(var, scopes):
+        for scope in scopes:
+            for other in scope_vars.get(scope, ()):
+                if other is not var:
+                    conflicts[var].add(other)
+                    conflicts[other].add(var)
+
+    for var in itertools.chain(local_uses, label_uses):
+        if var not in irregular_vars:
+            add_conflicts(var, scope_uses.get_scopes_using_local(var))
+    for name in global_uses:
+        add_conflicts(root.globals[name], scope_uses.get_scopes_using_global(name))
+    for name in member_uses:
+        add_conflicts(root.members[name], scope_uses.get_scopes_using_member(name))
+
+    # assign new names to identifiers, in order of frequency,
+    # each getting the first identifier (in the ideal order) not taken by a conflicting variable
+
+    idents = get_ident_sequence("".join(ident_chars))
+
+    def get_excludes(ident, label):
+        if label:
+            return label_excludes.get(ident, ())
+
+        excluded = []
+        if ident in global_excludes:
+            excluded.append(root.globals[ident])
+        if ident in member_excludes:
+            excluded.append(root.members[ident])
+        if ident in local_excludes:
+            excluded.extend(local_excludes[ident])
+        return excluded
+
+    taken = defaultdict(set) # var -> indices of idents given to conflicting vars
+    
+    def select_ident(key, var, renames, avoids, ident_vars, irregular_ident_vars, kind_idents=None, kind_excludes=None, label=False, prev_only=False):
+        irregular = var in irregular_vars
+        var_taken = taken[var]
 
-    local_renames, global_renames, member_renames, label_renames = {}, {}, {}, {}
+        def is_available(i, ident):
+            if i in var_taken or (kind_idents is not None and (i in kind_idents or ident == "_ENV" or ident in kind_excludes)):
+                return False
+            if (not label and ident == "_ENV") or (key in avoids and ident[0] in "bxBX"): # these chars cause extra space if placed after 0
+                return False
+            others = ident_vars[i] if irregular else irregular_ident_vars[i]
+            return all(are_vars_compatible(var, other) for other in itertools.chain(get_excludes(ident, label), others))
+
+        # prefer the identifiers given to this variable in the previous rename map, if still possible
+        for ident in prev_renames[var.kind].get(var.name, ()):
+            i = idents.index(ident)
+            if e(i) and is_available(i, ident):
+                break
+        else:
+            if prev_only:
+                return
+            i = kind_idents.first_free if kind_idents is not None else 0
+            while True:
+                if i not in var_taken and (kind_idents is None or i not in kind_idents):
+                    ident = idents[i]
+                    if kind_idents is not None and (ident == "_ENV" or ident in kind_excludes):
+                        kind_idents.add(i) # (can't be given to any var of this kind)
+                    elif is_available(i, ident):
+                        break
+                i += 1
 
-    def try_select_var(sel, excluded, renames, avoids, ident, var_map=None):
-        sel_var = var_map[sel] if var_map else sel
-        
-        if sel in avoids:
-            return False
+        renames[key] = ident
+        ident_vars[i].append(var)
+        if irregular:
+            irregular_ident_vars[i].append(var)
+        if kind_idents is not None:
+            kind_idents.add(i)
+        for other in conflicts.get(var, ()):
+            taken[other].add(i)
 
-        for exclude in excluded:
-            if not are_vars_compatible(sel_var, exclude):
-                return False
+    local_renames, global_renames, member_renames, label_renames = {}, {}, {}, {}
+    ident_vars, irregular_ident_vars = defaultdict(list), defaultdict(list)
+    global_idents, member_idents = IndexSet(), IndexSet() # (globals are never compatible with other globals, likewise for members)
+
+    def select_locals(prev_only):
+        for var in sorted(local_uses, key=lambda k: local_uses[k], reverse=True):
+            if var not in local_renames:
+                select_ident(var, var, local_renames, locals_after_zero, ident_vars, irregular_ident_vars, prev_only=prev_only)
+
+    def select_globals(prev_only):
+        for name in sorted(global_uses, key=lambda k: global_uses[k], reverse=True):
+            if name not in global_renames:
+                select_ident(name, root.globals[name], global_renames, globals_after_zero, ident_vars, irregular_ident_vars, global_idents, global_excludes, prev_only=prev_only)
+        for name in sorted(member_uses, key=lambda k: member_uses[k], reverse=True):
+            if name not in member_renames:
+                select_ident(name, root.members[name], member_renames, members_after_zero, ident_vars, irregular_ident_vars, member_idents, member_excludes, prev_only=prev_only)
+
+    label_ident_vars, irregular_label_ident_vars = defaultdict(list), defaultdict(list)
+    def select_labels(prev_only):
+        for var in sorted(label_uses, key=lambda k: label_uses[k], reverse=True):
+            if var not in label_renames:
+                select_ident(var, var, label_renames, (), label_ident_vars, irregular_label_ident_vars, label=True, prev_only=prev_only)
+
+    # (when reusing a previous rename map, its identifiers are given out first, so that new or more frequent vars don't take them)
+    for prev_only in (True, False) if prev_renames else (False,):
+        if (not focus.chars) != variant.swap_kinds: # going over locals first seems to usually increase compression (TODO...)
+            select_locals(prev_only)
+            select_globals(prev_only)
+        else:
+            select_globals(prev_only)
+            select_locals(prev_only)
+        select_labels(prev_only)
 
-        excluded.append(sel_var)
-        renames[sel] = ident
-        return True
-
-    def select_var(remaining, excluded, renames, avoids, ident, var_map=None, i=0):
-        while i < len(remaining):
-            if try_select_var(remaining[i], excluded, renames, avoids, ident, var_map):
-                del remaining[i]
-                return i
-            i += 1
-
-    def select_vars(remaining, excluded, renames, avoids, ident):
-        i = 0
-        while i != None:
-            i = select_var(remaining, excluded, renames, avoids, ident, i=i)
-
-    for ident in get_idents():
-        if not remaining_locals and not remaining_globals and not remaining_members and not remaining_labels:
-            break
-
-        avoid_locals = avoid_globals = avoid_members = ()
-        for ch in "bxBX": # these chars cause extra space if placed after 0
-            if ident.startswith(ch):
-                avoid_locals, avoid_globals, avoid_members = locals_after_zero, globals_after_zero, members_after_zero
-
-        if ident != "_ENV":
-            excluded = []
-            if ident in global_excludes:
-                excluded.append(root.globals[ident])
-            if ident in member_excludes:
-                excluded.append(root.members[ident])
-            if ident in local_excludes:
-                excluded.extend(local_excludes[ident])
-
-            if not focus.chars: # going over locals first seems to usually increase compression (TODO...)
-                select_vars(remaining_locals, excluded, local_renames, avoid_locals, ident)
-                select_var(remaining_globals, excluded, global_renames, avoid_globals, ident, root.globals)
-                select_var(remaining_members, excluded, member_renames, avoid_members, ident, root.members)
-            else:
-                select_var(remaining_globals, excluded, global_renames, avoid_globals, ident, root.globals)
-                select_var(remaining_members, excluded, member_renames, avoid_members, ident, root.members)
-                select_vars(remaining_locals, excluded, local_renames, avoid_locals, ident)
+    # (order the renames by identifier, as the rename map lists them)
+    def sort_renames(renames):
+        return dict(sorted(renames.items(), key=lambda item: idents.index(item[1])))
 
-        if remaining_labels:
-            excluded = list(label_excludes[ident])
-            select_vars(remaining_labels, excluded, label_renames, (), ident)
+    local_renames, global_renames = sort_renames(local_renames), sort_renames(global_renames)
+    member_renames, label_renames = sort_renames(member_renames), sort_renames(label_renames)
 
     if renamed_vars:
-        for var1, var2 in itertools.product(renamed_vars, renamed_vars):
-            if var1 != var2 and var1.rename == var2.rename and not are_vars_compatible(var1, var2):
-                throw(f"rename hint of {var1.name} to {var1.rename} conflicts with that of {var2.name} to {var2.rename}")
+        vars_by_rename = defaultdict(list)
+        for var in renamed_vars:
+            vars_by_rename[var.rename].append(var)
+
+        conflict_msgs = []
+        for rename_vars in vars_by_rename.values():
+            for var1, var2 in itertools.combinations(rename_vars, 2):
+                if not are_vars_compatible(var1, var2):
+                    conflict_msgs.append(f"rename hint of {var1.name} to {var1.rename} conflicts with that of {var2.name} to {var2.rename}")
+        
+        if conflict_msgs:
+            throw("\n".join(conflict_msgs))
 
     # output the identifier mapping, if needed
 
@@ -23,15 +23,39 @@ class StopTraverse(BaseException):
 
 k_skip_children = True # value returnable from traverse's pre-function
 
+class TraverseVisitor(Tuple):
+    """The callbacks of a single walk in traverse_nodes_multi (same meaning as traverse_nodes's parameters)"""
+    pre = post = tokens = None
+    extra = False
+
 class TokenNodeBase:
     """Baseclass for both pico8 Tokens and pico8 Nodes.
     The syntax tree is comprised of these and can be traversed via traverse_nodes or traverse_tokens"""
+    __slots__ = () # (Tokens and Comments are slotted, Nodes have a __dict__)
 
     def __init__(m):
         m.parent, m.children = None, ()
+        m.child_i = None # index in parent.children - kept up to date by the Node mutation methods
+
+    def get_child_i(m):
+        """Return this Token/Node's index in its parent's children, in constant time if the cached index is still valid"""
+        children = m.parent.children
+        i = m.child_i
+        if i is None or i >= len(children) or children[i] is not m: # (children modified directly)
+            i = m.child_i = children.index(m)
+        return i
+
+    def get_attrs(m):
+        """Return a dict of the attributes set on this Token/Node (whether slotted or not)"""
+        attrs = dict(getattr(m, "__dict__", ()))
+        for cls in type(m).__mro__:
+            for slot in cls.__dict__.get("__slots__", ()):
+                if hasattr(m, slot):
+                    attrs[slot] = getattr(m, slot)
+        return attrs
 
     def __str__(m):
-        return repr(m.__dict__)
+        return repr(m.get_attrs())
     
     def find_parent(m, type):
         parent = m.parent
@@ -43,7 +67,7 @@ class TokenNodeBase:
         parent = m.parent
         if parent is None:
             return None
-        i = parent.children.index(m) + delta
+        i = m.get_child_i() + delta
         return list_get(parent.children, i)
 
     def next_sibling(m): return m._sibling(1)
@@ -75,24 +99,74 @@ class TokenNodeBase:
     def last_token(m): return m._find_token(-1)
 
     def traverse_nodes(m, pre=None, post=None, tokens=None, extra=False):
-        skip = pre(m) if pre else None
-        if not skip:
-            for child in m.children:
-                if isinstance(child, Node):
-                    child.traverse_nodes(pre, post, tokens, extra)
+        # (iterative, to support deeply nested code. iterates the children lists as they change, like a for loop would)
+        stack = []
+        def enter(node):
+            if pre and pre(node): # k_skip_children
+                if post: post(node)
+            else:
+                stack.append([node, iter(node.children), False])
+
+        enter(m)
+        while stack:
+            frame = stack[-1]
+            node, children, in_extra = frame
+            for child in children:
+                if in_extra or isinstance(child, Node):
+                    enter(child)
+                    break
                 elif tokens:
                     tokens(child)
-            if extra and hasattr(m, "extra_children"):
-                for child in m.extra_children:
-                    child.traverse_nodes(pre, post, tokens, extra)
-        if post: post(m)
+            else:
+                if extra and not in_extra and hasattr(node, "extra_children"):
+                    frame[1:] = iter(node.extra_children), True
+                else:
+                    stack.pop()
+                    if post: post(node)
+
+    def traverse_nodes_multi(m, visitors):
+        """Like calling traverse_nodes once per TraverseVisitor in 'visitors', but in a single walk.
+        Only valid if the visitors don't depend on each other's results (or order) during the walk"""
+        stack = []
+        def enter(node, active):
+            children_active = tuple(visitor for visitor in active if not (visitor.pre and visitor.pre(node)))
+            stack.append([node, iter(node.children), active, children_active, False])
+
+        enter(m, tuple(visitors))
+        while stack:
+            frame = stack[-1]
+            node, children, active, children_active, in_extra = frame
+            done = True
+            if children_active:
+                for child in children:
+                    if in_extra or isinstance(child, Node):
+                        enter(child, children_active)
+                        done = False
+                        break
+                    else:
+                        for visitor in children_active:
+                            if visitor.tokens: visitor.tokens(child)
+
+            if done:
+                extra_active = () if in_extra else tuple(visitor for visitor in children_active if visitor.extra)
+                if extra_active and hasattr(node, "extra_children"):
+                    frame[1:] = iter(node.extra_children), active, extra_active, True
+                else:
+                    stack.pop()
+                    for visitor in active:
+                        if visitor.post: visitor.post(node)
 
     def traverse_tokens(m, visit):
-        for child in m.children:
-            if isinstance(child, Node):
-                child.traverse_tokens(visit)
+        stack = [iter(m.children)]
+        while stack:
+            for child in stack[-1]:
+                if isinstance(child, Node):
+                    stack.append(iter(child.children))
+                    break
+                else:
+                    visit(child)
             else:
-                visit(child)
+                stack.pop()
     
     def traverse_parents(m, visit):
         parent = m.parent
@@ -117,6 +191,8 @@ class Token(TokenNodeBase):
     """A pico8 token, at 'source'.text['idx':'endidx'] (which is equal to its 'value'). Its 'type' is a TokenType.
     For number/string tokens, the actual value can be read via parse_fixnum/parse_string_literal
     Its children are the comments *before* it, if any."""
+    __slots__ = ("parent", "children", "child_i", "type", "value", "source", "idx", "endidx", "vline", "modified",
+                 "__dict__") # (only created for the rare attributes set by hint comments - e.g. var_kind, sublang)
 
     def __init__(m, type, value, source, idx, endidx, vline=None, modified=False):
         super().__init__()
@@ -153,6 +229,7 @@ class CommentHint(Enum):
 
 class Comment(TokenNodeBase):
     """A pico8 comment, optionally holding some kind of hint"""
+    __slots__ = ("parent", "children", "child_i", "hint", "hintdata", "source", "idx", "endidx")
 
     def __init__(m, hint, hintdata=None, source=None, idx=None, endidx=None):
         super().__init__()
@@ -185,7 +262,27 @@ class NextTokenMods:
             m.comments = []
         m.comments.append(cmt)
 
-def tokenize(source, ctxt=None, all_comments=False):
+class TokenizeEngine(Enum):
+    """How tokenize scans the source - via a compiled regex (the default), or char by char (the reference)"""
+    regex = chars = ...
+
+k_token_re = re.compile(r"[ \t\r\n]*(?:" + "|".join((
+    r"(?P<number>0[bB][01]*(?:\.[01]*)?|0[xX][0-9a-fA-F]*(?:\.[0-9a-fA-F]*)?|[0-9]+(?:\.[0-9]*)?|\.[0-9]+)",
+    r"(?P<ident>[A-Za-z_\x1e\x1f\x80-\U0010ffff][0-9A-Za-z_\x1e\x1f\x80-\U0010ffff]*)",
+    # (strings with \z escapes or without an end are left to the chars engine)
+    r"""(?P<string>"[^"\\\n]*(?:\\[^z][^"\\\n]*)*"|'[^'\\\n]*(?:\\[^z][^'\\\n]*)*')""",
+    r"(?P<comment>--|//)",
+    r"(?P<punct>\.\.\.|\.\.=?|::|\^\^=?|>>>=?|>><=?|<<>=?|>>=?|<<=?|[-+*/\\%&|^<>=~]=?|[#()\]{};,?@$.:]|\[(?![=\[])|!=)",
+)) + ")?")
+
+k_token_re_types = {
+    "ident": TokenType.ident,
+    "number": TokenType.number,
+    "string": TokenType.string,
+    "punct": TokenType.punct,
+}
+
+def tokenize(source, ctxt=None, all_comments=False, engine=TokenizeEngine.regex):
     text = source.text
     idx = 0
     vline = 0
@@ -415,7 +512,8 @@ def tokenize(source, ctxt=None, all_comments=False):
         else:
             add_error("Invalid long brackets")
 
-    while idx < len(text):
+    def tokenize_next():
+        nonlocal vline
         ch = take()
 
         if ch in k_wspace: # whitespace
@@ -460,10 +558,59 @@ def tokenize(source, ctxt=None, all_comments=False):
         else:
             add_error("invalid character")
     
+    if engine == TokenizeEngine.chars:
+        while idx < len(text):
+            tokenize_next()
+    
+    else: # same results, but consumes whole tokens (and whitespace) at once
+        text_len = len(text)
+        match_token = k_token_re.match
+        append_token = tokens.append
+        while idx < text_len:
+            match = match_token(text, idx) # (whitespace, followed by a token, if possible)
+            kind = match.lastgroup
+            if kind:
+                start, end = match.span(kind)
+            else:
+                start = end = match.end()
+                if end == idx:
+                    tokenize_next()
+                    continue
+
+            if start > idx:
+                vline += text.count("\n", idx, start)
+            idx = end
+
+            if not kind:
+                pass
+
+            elif kind == "comment":
+                if text[start] == '/' or not tokenize_long_comment():
+                    end = text.find("\n", idx)
+                    orig_idx, idx = idx, end + 1 if end >= 0 else text_len + 1
+                    vline += 1
+                    process_comment(start, text[orig_idx:idx], isblock=False)
+
+            else:
+                value = text[start:end]
+                type = k_token_re_types[kind]
+                if type is TokenType.ident and value in keywords:
+                    type = TokenType.keyword
+
+                if next_mods is None: # (add_token, inlined)
+                    append_token(Token(type, value, source, start, end, vline))
+                else:
+                    add_token(type, start, value=value)
+    
     if next_mods or all_comments:
         add_token(None, idx) # end token, for ending whitespace/comments/etc
     return tokens, errors
 
+k_uncounted_values = (",", ".", ":", ";", "::", ")", "]", "}", "end", "local", None)
+k_unary_number_ops = ("-", "~")
+k_not_before_unary_types = (TokenType.number, TokenType.string, TokenType.ident)
+k_not_before_unary_values = (")", "]", "}", ";", "end")
+
 def count_tokens(tokens):
     count = 0
     for i, token in enumerate(tokens):
@@ -472,18 +619,124 @@ def count_tokens(tokens):
                 if comment.hint == CommentHint.lint and k_lint_count_stop in comment.hintdata:
                     return count
 
-        if token.value in (",", ".", ":", ";", "::", ")", "]", "}", "end", "local", None):
+        if token.value in k_uncounted_values:
             continue
 
-        if token.value in ("-", "~") and i+1 < len(tokens) and tokens[i+1].type == TokenType.number and \
+        if token.value in k_unary_number_ops and i+1 < len(tokens) and tokens[i+1].type == TokenType.number and \
             token.endidx == tokens[i+1].idx and \
-            i-1 >= 0 and tokens[i-1].type not in (TokenType.number, TokenType.string, TokenType.ident) and \
-            tokens[i-1].value not in (")", "]", "}", ";", "end"):
+            i-1 >= 0 and tokens[i-1].type not in k_not_before_unary_types and \
+            tokens[i-1].value not in k_not_before_unary_values:
             continue
 
         count += 1
     return count
 
+k_long_brackets_re = re.compile(r"\[(=*)\[")
+
+def count_tokens_fast(text, ctxt=None):
+    """Count the tokens in 'text' the same way count_tokens(tokenize(...)) would, without creating any Tokens.
+    Returns None if tokenize would return errors (or if sub-languages may be involved), in which case tokenize should be used"""
+    process_hints = ctxt and ctxt.hint_comments
+    check_sublangs = ctxt and ctxt.sublang_getter
+
+    def skip_long_brackets(idx):
+        match = k_long_brackets_re.match(text, idx)
+        if match:
+            pad = match.group(1)
+            end = text.find(f"]{pad}]", match.end())
+            if end >= 0:
+                return match.end(), end, end + len(pad) + 2
+        return None, None, None
+
+    def skip_string(idx): # (strings k_token_re leaves to the chars engine)
+        quote = text[idx]
+        idx += 1
+        while idx < text_len:
+            ch = text[idx]
+            idx += 1
+            if ch == '\n':
+                break
+            elif ch == '\\':
+                if text[idx:idx + 1] == 'z':
+                    idx += 1
+                    while idx < text_len and text[idx] in k_wspace:
+                        idx += 1
+                else:
+                    idx += 1
+            elif ch == quote:
+                return idx
+        return None
+
+    text_len = len(text)
+    match_token = k_token_re.match
+    count = idx = 0
+    prev_type = prev_value = None
+    unary_end = None # set if the previous token is uncounted if an adjacent number follows it
+    stopped = False
+
+    while idx < text_len:
+        match = match_token(text, idx)
+        kind = match.lastgroup
+        if kind:
+            start, idx = match.span(kind)
+        else:
+            start = end = match.end()
+            if end == idx: # string with \z, long string, or something that needs the full tokenizer
+                if text[idx] in ('"', "'"):
+                    end = skip_string(idx)
+                else:
+                    _, _, end = skip_long_brackets(idx)
+                if end is None:
+                    return None
+                kind = "string"
+            idx = end
+
+        if not kind:
+            continue
+
+        elif kind == "comment":
+            cmt_start, cmt_end, end = skip_long_brackets(idx) if text[start] == '-' else (None, None, None)
+            isblock = end is not None
+            if not isblock:
+                end = text.find("\n", idx)
+                cmt_start, cmt_end = idx, (end + 1 if end >= 0 else text_len)
+                end = cmt_end
+            idx = end
+
+            if process_hints:
+                comment = text[cmt_start:cmt_end]
+                if comment.startswith(k_lint_prefix) and k_lint_count_stop in k_hint_split_re.split(comment[len(k_lint_prefix):]):
+                    if unary_end is not None: # (the comment separates it from any number)
+                        count += 1
+                        unary_end = None
+                    stopped = True
+                elif check_sublangs and isblock and comment.startswith(k_language_prefix):
+                    return None
+            continue
+        
+        value = text[start:idx]
+        type = k_token_re_types[kind]
+        if type is TokenType.ident and value in keywords:
+            type = TokenType.keyword
+
+        if unary_end is not None:
+            if not (type is TokenType.number and start == unary_end):
+                count += 1
+            unary_end = None
+
+        if not stopped and value not in k_uncounted_values:
+            if value in k_unary_number_ops and prev_value is not None and \
+                    prev_type not in k_not_before_unary_types and prev_value not in k_not_before_unary_values:
+                unary_end = idx
+            else:
+                count += 1
+        
+        prev_type, prev_value = type, value
+
+    if unary_end is not None:
+        count += 1
+    return count
+
 # fixnum - an integer representing a 16.16 pico8 fixed-point number
 # e.g. 
 # This may become a class in the future, but is a convention now.
@@ -74,7 +74,7 @@ def unminify_code(root, unminify_opts):
 
         elif curr_stmt is None:
             if is_function_stmt(node):
-                child_i = node.parent.children.index(node)
+                child_i = node.get_child_i()
                 if child_i > 0 and not is_function_stmt(node.parent.children[child_i - 1]):
                     output.append("\n")
 
@@ -41,7 +41,7 @@ def try_read_dir_contents(dir):
     return results
 
 def run_test(name, input, output, *args, private=False, check_output=True, from_output=False,
-             read_stdout=False, norm_stdout=nop, exit_code=0, extra_outputs=None, output_reader=try_file_read,
+             read_stdout=False, read_stderr=False, norm_stdout=nop, exit_code=0, extra_outputs=None, output_reader=try_file_read,
              pico8_output_val=None, pico8_output=None, copy_in_to_out=False):
     if g_opts.test:
         for wanted_test in g_opts.test:
@@ -66,7 +66,7 @@ def run_test(name, input, output, *args, private=False, check_output=True, from_
     else:
         args = (inpath, outpath) + args
 
-    run_success, run_stdout = run_code(*args, exit_code=exit_code)
+    run_success, run_stdout = run_code(*args, exit_code=exit_code, with_stderr=read_stderr)
     success = run_success
     stdouts = [run_stdout]
 
@@ -120,6 +120,252 @@ def run_test(name, input, output, *args, private=False, check_output=True, from_
 def run_stdout_test(name, input, *args, output=None, **kwargs):
     run_test(name, input, output, *args, **kwargs, read_stdout=True)
 
+def run_code_test(name, check):
+    """run an in-process test, where 'check' returns an error message on failure (or None on success)"""
+    if g_opts.test and not any(fnmatch.fnmatch(name, wanted_test) for wanted_test in g_opts.test):
+        return None
+    
+    start_test()
+    error = check()
+    if error:
+        print(f"\nERROR - test {name} failed")
+        print(error)
+        fail_test()
+        return False
+    
+    if g_opts.verbose:
+        print(f"\nTest {name} succeeded")
+    return True
+
+def run_tokenize_test(name, input):
+    """check that the regex tokenizer engine gives the same results as the (reference) chars engine"""
+    def check():
+        from pico_process import PicoContext, PicoSource
+        from pico_tokenize import tokenize, count_tokens, count_tokens_fast, TokenizeEngine
+        from pico_cart import read_cart
+
+        def describe(tokens, errors):
+            results = []
+            for token in tokens:
+                attrs = {key: val for key, val in token.get_attrs().items() if key not in ("source", "parent", "children", "sublang")}
+                comments = [(cmt.hint, cmt.hintdata, cmt.idx, cmt.endidx) for cmt in token.children]
+                results.append((sorted(attrs.items(), key=str), comments))
+            return results, [(error.msg, error.token.idx, error.token.endidx) for error in errors]
+
+        text = read_cart(path_join("test_input", input)).code
+        for ctxt, all_comments in ((None, False), (PicoContext(), True)):
+            expected = describe(*tokenize(PicoSource(input, text), ctxt, all_comments, engine=TokenizeEngine.chars))
+            actual = describe(*tokenize(PicoSource(input, text), ctxt, all_comments, engine=TokenizeEngine.regex))
+            if actual != expected:
+                return f"Tokenizer engines differ on {input} (all_comments={all_comments})"
+
+            tokens, errors = tokenize(PicoSource(input, text), ctxt, all_comments)
+            expected_count = None if errors else count_tokens(tokens)
+            actual_count = count_tokens_fast(text, ctxt)
+            if actual_count != expected_count:
+                return f"count_tokens_fast gave {actual_count} instead of {expected_count} on {input}"
+
+    return run_code_test(name, check)
+
+def run_traverse_test(name, input):
+    """check that traverse_nodes_multi visits the same nodes, in the same order, as separate traverse_nodes walks"""
+    def check():
+        from pico_process import PicoContext, PicoSource
+        from pico_tokenize import tokenize, TraverseVisitor, k_skip_children
+        from pico_parse import parse, NodeType
+        from pico_cart import read_cart
+
+        def make_visitor(log, skip_type, extra):
+            return TraverseVisitor(pre=lambda node: log.append(("pre", node)) or (node.type == skip_type and k_skip_children),
+                                   post=lambda node: log.append(("post", node)),
+                                   tokens=lambda token: log.append(("token", token)), extra=extra)
+
+        text = read_cart(path_join("test_input", input)).code
+        ctxt = PicoContext()
+        tokens, errors = tokenize(PicoSource(input, text), ctxt)
+        root, errors = parse(PicoSource(input, text), tokens, ctxt)
+        if errors:
+            return f"Parse errors on {input}"
+        
+        expected_logs, actual_logs = [[], []], [[], []]
+        for logs, multi in ((expected_logs, False), (actual_logs, True)):
+            visitors = [make_visitor(logs[0], None, True), make_visitor(logs[1], NodeType.function, False)]
+            if multi:
+                root.traverse_nodes_multi(visitors)
+            else:
+                for visitor in visitors:
+                    root.traverse_nodes(visitor.pre, visitor.post, visitor.tokens, visitor.extra)
+
+        if actual_logs != expected_logs:
+            return f"Traversals differ on {input}"
+
+    return run_code_test(name, check)
+
+def run_incremental_parse_test(name, input, num_tabs):
+    """check that IncrementalParser gives the same results as a full parse, as tabs of the input are edited"""
+    def check():
+        from pico_process import PicoContext, PicoSource, IncrementalParser
+        from pico_tokenize import tokenize
+        from pico_preprocess import k_tab_break
+        from pico_parse import parse
+        from pico_lint import lint_code
+        from pico_rename import rename_tokens
+        from pico_minify import minify_code
+        from pico_cart import read_cart
+
+        lines = read_cart(path_join("test_input", input)).code.split("\n")
+        func_starts = [i for i, line in enumerate(lines) if line.startswith("function ")] # (likely top-level)
+        starts = [0] + func_starts[1::max(len(func_starts) // num_tabs, 1)] + [len(lines)]
+        tabs = ["\n".join(lines[start:end]) for start, end in zip(starts, starts[1:])]
+        versions = [list(tabs)]
+        tabs[1] = "local zq=1\n" + tabs[1]
+        versions.append(list(tabs))
+        tabs[0] += "\nzq=2"
+        versions.append(list(tabs))
+        del tabs[-2]
+        versions.append(list(tabs))
+
+        def process(text, parser):
+            ctxt = PicoContext()
+            source = PicoSource(input, text)
+            tokens, _ = tokenize(source, ctxt)
+            root, errors = parser.parse(source, tokens) if parser else parse(source, tokens, ctxt)
+            if root:
+                errors += lint_code(ctxt, root, {})
+            return root, ctxt, [(error.msg, error.token.idx) for error in errors]
+
+        parser = IncrementalParser(PicoContext())
+        for tabs in versions:
+            text = k_tab_break.join(tabs)
+            root, ctxt, actual = process(text, parser)
+            expected_root, expected_ctxt, expected = process(text, None)
+            if actual != expected:
+                return f"Incremental parse gave different errors on {input}"
+        
+        rename_tokens(ctxt, root, {})
+        rename_tokens(expected_ctxt, expected_root, {})
+        if minify_code(ctxt, root, {}) != minify_code(expected_ctxt, expected_root, {}):
+            return f"Incremental parse gave different minified output on {input}"
+
+    return run_code_test(name, check)
+
+def run_incremental_compress_test(name, input, num_edits):
+    """check that compress_code_incremental gives the same results as compress_code, as the input is randomly edited"""
+    def check():
+        from pico_compress import compress_code, compress_code_incremental, uncompress_code
+        from pico_cart import read_cart
+
+        code = read_cart(path_join("test_input", input)).code[:0x4000] # (keep it quick)
+        rand = random.Random(input)
+        result = resynced = compress_code_incremental(code)
+        for _ in range(num_edits):
+            start = rand.randrange(len(code) + 1)
+            end = min(start + rand.randrange(0x40), len(code))
+            if rand.randrange(2): # (likely to create new matches)
+                copy_start = rand.randrange(len(code))
+                insert = code[copy_start:copy_start + rand.randrange(0x40)]
+            else:
+                insert = "".join(rand.choice("abc =()\n1") for _ in range(rand.randrange(0x40)))
+            code = code[:start] + insert + code[end:]
+
+            w = BinaryWriter(big_end=True)
+            compress_code(w, code, force_compress=True, fail_on_error=False)
+            result = compress_code_incremental(code, result)
+            if result.data != w.f.getvalue():
+                return f"Incremental compression differs from compress_code on {input} (size {len(result.data)} vs {len(w.f.getvalue())})"
+
+            resynced = compress_code_incremental(code, resynced, resync=True)
+            for data in (result.data, resynced.data):
+                if uncompress_code(BinaryReader(BytesIO(data), big_end=True)) != code:
+                    return f"Incremental compression gave corrupt data on {input}"
+
+    return run_code_test(name, check)
+
+def run_lz4_test(name):
+    """check that the pod lz4 codec round-trips & follows lz4's end-of-block rules, with and without the lz4 module
+    (and that the compressed data is the same either way)"""
+    def check():
+        import pico_cart, pico_export # (in this order, due to circular imports)
+        from pico_export import PodFile
+        lz4_modules = [None] + ([pico_export.lz4_block] if pico_export.lz4_block else [])
+
+        def follows_lz4_rules(compressed, size):
+            """check that the last match starts at least 12 bytes before the end, and that the last 5 bytes are literals"""
+            pos = unc_pos = 0
+            def read_u8_sum(val):
+                nonlocal pos
+                while compressed[pos] == 0xff:
+                    val += 0xff; pos += 1
+                val += compressed[pos]; pos += 1
+                return val
+
+            while True:
+                header = compressed[pos]
+                pos += 1
+                lit_size = read_u8_sum(0xf) if header >> 4 == 0xf else header >> 4
+                pos += lit_size
+                unc_pos += lit_size
+                if pos >= len(compressed):
+                    return unc_pos == size
+                
+                pos += 2 # offset
+                count = read_u8_sum(0x13) if header & 0xf == 0xf else 4 + (header & 0xf)
+                if unc_pos > size - 12 or unc_pos + count > size - 5:
+                    return False
+                unc_pos += count
+
+        rand = random.Random(name)
+        for size in (0, 1, 4, 5, 11, 12, 13, 14, 17, 100, 0x1000, 0x12345):
+            for kind, data in (("zero", bytes(size)),
+                               ("random", bytes(rand.randrange(0x100) for _ in range(size))),
+                               ("repetitive", bytes(rand.choice(b"pico") for _ in range(size)))):
+                desc = f"{kind} data of size {size}"
+                compressed = []
+                for lz4_module in lz4_modules:
+                    with patch.object(pico_export, "lz4_block", lz4_module):
+                        compressed.append(PodFile.lz4_compress(None, data))
+                if any(comp != compressed[0] for comp in compressed):
+                    return f"lz4 compression of {desc} differs with and without the lz4 module"
+                
+                comp = compressed[0]
+                if not follows_lz4_rules(comp, size):
+                    return f"lz4 end-of-block rules broken for {desc}"
+                
+                for lz4_module in lz4_modules:
+                    with patch.object(pico_export, "lz4_block", lz4_module):
+                        if PodFile.lz4_uncompress(None, comp, size) != data or PodFile.lz4_uncompress(None, comp) != data:
+                            return f"lz4 roundtrip failed for {desc} (decompressed {'with' if lz4_module else 'without'} the lz4 module)"
+
+    return run_code_test(name, check)
+
+def run_compress_variant_fallback_test(name, input):
+    """check that compression with effort falls back to the default variant if no variant decompresses correctly"""
+    def check():
+        from pico_cart import read_cart
+        import pico_compress
+        from pico_compress import compress_code, compress_code_best_variant
+        code = read_cart(path_join("test_input", input)).code
+
+        w = BinaryWriter()
+        compress_code(w, code, force_compress=True, fail_on_error=False)
+        with patch.object(pico_compress, "ProcessPoolExecutor", side_effect=OSError), \
+             patch.object(pico_compress, "uncompress_code", return_value=None):
+            result = compress_code_best_variant(code, 3, False)
+        if result != (w.f.getvalue(), 0):
+            return "didn't fall back to the default variant"
+
+    return run_code_test(name, check)
+
+def run_rename_map_reuse_test(name, prev_map, new_map):
+    """check that all the renames in the rename map 'prev_map' were kept in the rename map 'new_map'"""
+    def check():
+        renames = set(file_read_text(new_map).splitlines())
+        lost = [line for line in file_read_text(prev_map).splitlines() if line not in renames]
+        if lost:
+            return f"{len(lost)} previous renames weren't kept, e.g.: {lost[0]}"
+
+    return run_code_test(name, check)
+
 def run():
     if run_test("minify", "input.p8", "output.p8", "--minify",
                 "--preserve", "*.preserved_key,preserved_glob,preserving_obj.*", pico8_output="output.p8.printh"):
@@ -146,6 +392,8 @@ def run():
         run_test("unmintest", "test.p8", "test-un.p8", "--unminify", from_output=True, pico8_output_val="DONE")
     run_test("test-ob", "test.p8", "test-ob.p8", "--focus-compressed", "--minify", pico8_output_val="DONE")
     run_test("test-oc", "test.p8", "test-oc.p8", "--focus-chars", "--minify", pico8_output_val="DONE")
+    run_test("test-ob-effort", "test.p8", "test-ob-effort.p8", "--focus-compressed", "--minify", "--rename-effort", "8", pico8_output_val="DONE")
+    run_test("test-oc-effort", "test.p8", "test-oc-effort.p8", "--focus-chars", "--minify", "--rename-effort", "8", pico8_output_val="DONE")
     run_test("globasmemb", "globasmemb.p8", "globasmemb.p8", "--minify", pico8_output_val="OK")
     if run_test("p82png", "testcvt.p8", "testcvt.png",
                 "--extra-output", "test_output/testcvt.sprites.png", "spritesheet",
@@ -159,6 +407,31 @@ def run():
     run_test("png2p8", "test.png", "testcvt.p8")
     if run_test("compress", "testcvt.p8", "testtmp.png", "--force-compression", check_output=False):
         run_test("compress_check", "testtmp.png", "test_post_compress.p8", from_output=True)
+    if run_test("optimal_compress", "testcvt.p8", "testtmp_optimal.png", "--force-compression",
+                "--optimal-compression", "--optimal-compression-time", "0", check_output=False):
+        run_test("optimal_compress_check", "testtmp_optimal.png", "test_post_compress.p8", from_output=True)
+    run_stdout_test("optimal_count", "testcvt.p8", "--count", "--optimal-compression", "--optimal-compression-time", "0",
+                    output="optimal_count.txt")
+    run_stdout_test("optimal_count_default", "manylocals.p8", "--count", "--optimal-compression", "--optimal-compression-time", "0",
+                    output="optimal_count_default.txt") # (where the search's result is larger than the default compression's)
+    if run_test("cache_compress", "testcvt.p8", "testtmp_cache.png", "--force-compression", "--cache-dir", "test_output/cache", check_output=False) and \
+       run_test("cache_compress_hit", "testcvt.p8", "testtmp_cache.png", "--force-compression", "--cache-dir", "test_output/cache", check_output=False):
+        run_test("cache_compress_check", "testtmp_cache.png", "test_post_compress.p8", from_output=True)
+    for path in try_dir_paths("test_output/cache_count", ()): # (start from a cold cache)
+        file_delete(path)
+    if run_test("cache_count", "testcvt.p8", "testtmp_cache_count.p8", "--count", "--cache-dir", "test_output/cache_count", check_output=False) and \
+       run_test("cache_count_png", "testcvt.p8", "testtmp_cache_count.png", "--force-compression", "--cache-dir", "test_output/cache_count", check_output=False):
+        run_test("cache_count_check", "testtmp_cache_count.png", "test_post_compress.p8", from_output=True)
+    if run_test("count_extra_png", "test.p8", "testtmp_count_extra.p8", "--count", "-m", "--force-compression",
+                "--extra-output", "test_output/testtmp_count_extra.png", check_output=False):
+        run_test("count_extra_png_check", "testtmp_count_extra.png", "test-count-extra.p8", from_output=True)
+    if run_test("effort_compress", "testcvt.p8", "testtmp_effort.png", "--force-compression", "--compression-effort", "3", check_output=False):
+        run_test("effort_compress_check", "testtmp_effort.png", "test_post_compress.p8", from_output=True)
+    run_stdout_test("effort_count", "testcvt.p8", "test_output/testtmp_effort_count.png", "--force-compression", "--compression-effort", "3",
+                    "--count", "--parsable-count", output="effort_count.txt")
+    run_compress_variant_fallback_test("effort_fallback", "testcvt.p8")
+    run_test("timings", "testcvt.p8", "testtmp_timings.png", "--count", "--timings-json", "test_output/timings.json",
+             "--profile-out", "test_output/timings.prof", check_output=False)
     if run_test("old_compress", "testcvt.p8", "testtmp_old.png", "--force-compression", "--old-compression", check_output=False):
         run_test("old_compress_check", "testtmp_old.png", "test_post_compress_old.p8", from_output=True)
         run_test("old_compress_keep", "testtmp_old.png", "testtmp_old.png", "--keep-compression", from_output=True)
@@ -197,9 +470,14 @@ def run():
         run_test("repl-com", "repl.p8", "repl-com.png", "--force-compression", from_output=True, pico8_output_val="finished")
     run_test("repl-oc", "repl.p8", "repl-oc.p8", "--minify", "--focus-chars", pico8_output_val="finished")
     run_test("repl-ob", "repl.p8", "repl-ob.p8", "--minify", "--focus-compressed", pico8_output_val="finished")
+    if run_test("repl-mapin", "repl-edit.p8", "repl-mapin.p8", "--minify", "--rename-map-in", "test_input/repl.map",
+                "--rename-map", "test_output/repl-mapin.map", extra_outputs=["repl-mapin.map"], pico8_output_val="finished"):
+        run_rename_map_reuse_test("repl-mapin-reuse", "test_input/repl.map", "test_output/repl-mapin.map")
     run_test("reformat", "input.p8", "input-reformat.p8", "--unminify", "--unminify-indent", "4")
     run_test("notnil", "notnil.p8", "notnil.p8", "--minify", pico8_output_val="passed")
     run_test("wildcards", "wildcards.p8", "wildcards.p8", "--minify")
+    run_stdout_test("renameconflict", "renameconflict.p8", "test_output/renameconflict.p8", "--minify",
+                    output="renameconflict.txt", read_stderr=True, exit_code=1)
     run_test("reorder", "reorder.p8", "reorder.p8", "-m", "--focus-tokens", "--no-minify-lines", 
              pico8_output="reorder.p8.printh")
     run_test("reorder_safe", "reorder.p8", "reorder_safe.p8", "-M", "--focus-tokens", "--no-minify-lines", 
@@ -210,6 +488,16 @@ def run():
     run_test("short-lines", "short.p8", "short-lines.p8", "-m", "--no-minify-lines", "--focus-chars", pico8_output_val="K\nK")
     run_test("short-spaces", "short.p8", "short-spaces.p8", "-m", "--no-minify-spaces", "--focus-chars", pico8_output_val="K\nK")
     run_test("short2", "short2.p8", "short2.p8", "-m", "--focus-compressed", "--no-minify-spaces")
+    run_test("manylocals", "manylocals.p8", "manylocals.p8", "--minify", pico8_output_val="8235")
+    for input in ("input.p8", "test.p8", "repl.p8", "bad.p8", "worse.p8", "sublang.p8", "short.p8", "included space.lua"):
+        run_tokenize_test(f"tokenize-{input}", input)
+    for input in ("input.p8", "test.p8", "repl.p8"):
+        run_traverse_test(f"traverse-{input}", input)
+    for input in ("input.p8", "test.p8", "repl.p8"):
+        run_incremental_parse_test(f"incremental-{input}", input, 8)
+    run_lz4_test("lz4")
+    for input in ("test.p8", "repl.p8", "script.p8"):
+        run_incremental_compress_test(f"incremental-compress-{input}", input, 8)
 
 def main(raw_args):
     global g_opts
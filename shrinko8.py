@@ -5,7 +5,7 @@ from pico_compress import write_code_size, write_compressed_size, CompressionTra
 from pico_cart import Cart, CartFormat, read_cart, write_cart, get_bbs_cart_url, merge_cart
 from pico_export import read_cart_export, read_pod_file, ListOp
 from pico_tokenize import k_hint_split_re
-import argparse
+import argparse, multiprocessing, cProfile
 
 k_version = 'v1.1.2f'
 
@@ -57,6 +57,9 @@ pgroup.add_argument("--rename-safe-only", action="store_true", help="only do ren
 pgroup.add_argument("--rename-members-as-globals", action="store_true", help='rename globals and members the same way (same as --preserve "*=*.*")')
 pgroup.add_argument("--reorder-safe-only", action="store_true", help="only do statement reordering that's always safe to do (subset of --minify-safe-only)")
 pgroup.add_argument("--rename-map", help="log renaming of identifiers (from minify step) to this file")
+pgroup.add_argument("--rename-map-in", help="reuse the renaming logged by a previous --rename-map to this file, where still possible (ignored if the file doesn't exist)")
+pgroup.add_argument("--rename-effort", type=int, metavar="N", help="try N variants of the renaming parameters in parallel, keeping the best one per the focus: fewest tokens (--focus-tokens), then fewest chars (--focus-chars), then smallest compressed size (default: 1)")
+pgroup.add_argument("--rename-effort-time", type=float, metavar="SECONDS", help="stop trying more variants for --rename-effort after this many seconds (default: no limit)")
 
 pgroup = parser.add_argument_group("lint options")
 pgroup.add_argument("-l", "--lint", action="store_true", help="enable checking the cart for common issues")
@@ -117,9 +120,18 @@ pgroup.add_argument("--keep-compression", action="store_true", help="keep existi
 pgroup.add_argument("--fast-compression", action="store_true", help="force fast but poor compression (when creating png carts)")
 pgroup.add_argument("--force-compression", action="store_true", help="force code compression even if code fits (when creating png carts)")
 pgroup.add_argument("--old-compression", action="store_true", help="compress with the old pre-v0.2.0 compression scheme")
+pgroup.add_argument("--optimal-compression", action="store_true", help="compress via a slower search for the optimal encoding (also used for --count). The result depends on the time budget (see --optimal-compression-time) and so on the machine's speed, but is never larger than the default compression's")
+pgroup.add_argument("--optimal-compression-time", type=float, metavar="SECONDS", help="spend up to this many seconds refining the optimal compression (default: 1)")
+pgroup.add_argument("--compression-effort", type=int, metavar="N", help="try N variants of the compression parameters in parallel, keeping the smallest result. Under --count, the chosen variant is printed as well (default: 1)")
+pgroup.add_argument("--cache-dir", help="cache compressed code in this directory, to avoid re-compressing unchanged code across runs")
 pgroup.add_argument("--trace-compression", help="trace the compressed symbols and their cost into this file")
 pgroup.add_argument("--trace-input-compression", help="trace the input's compressed symbols and their cost into this file")
 
+pgroup = parser.add_argument_group("profiling options (semi-undocumented)")
+pgroup.add_argument("--timings", action="store_true", dest="print_timings", help="print the time spent in each stage of processing (to stderr)")
+pgroup.add_argument("--timings-json", help="write the time spent in each stage of processing to this file, as json")
+pgroup.add_argument("--profile-out", help="profile the run and write the stats (in pstats format) to this file")
+
 pgroup = parser.add_argument_group("other uninteresting options (semi-undocumented)")
 pgroup.add_argument("--builtin", type=SplitBySeps, action=extend_arg, help="treat identifier(s) as a pico-8 builtin (for minify, lint, etc.)")
 pgroup.add_argument("--not-builtin", type=SplitBySeps, action=extend_arg, help="do not treat identifier(s) as a pico-8 builtin (for minify, lint, etc.)")
@@ -229,6 +241,9 @@ def main_inner(raw_args):
             "safe-only": args.minify_safe_only or args.rename_safe_only,
             "focus": args.focus,
             "rules": args.preserve or (),
+            "effort": args.rename_effort or 1,
+            "effort-time": args.rename_effort_time,
+            "prev-map": try_file_read_text(args.rename_map_in) if args.rename_map_in else None,
         }
 
     if args.unminify:
@@ -255,12 +270,31 @@ def main_inner(raw_args):
     if args.trace_compression:
         args.trace_compression = CompressionTracer(args.trace_compression)
 
+    args.cache = DiskCache(args.cache_dir, salt=k_version) if args.cache_dir else None
+
+    args.timings = StageTimings() if args.print_timings or args.timings_json else None
+    profiler = cProfile.Profile() if args.profile_out else None
+    if profiler:
+        profiler.enable()
+
+    try:
+        return handle_all(args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.profile_out)
+        if args.timings:
+            handle_timings(args)
+
+def handle_all(args):
     if args.input:
-        cart, extra_carts = handle_input(args)
+        with timed_stage(args.timings, "read"):
+            cart, extra_carts = handle_input(args)
         if cart is None: # e.g. list/dump case
             return 0
         
-        passed, ok = handle_processing(args, cart, extra_carts)
+        with timed_stage(args.timings, "process"):
+            passed, ok = handle_processing(args, cart, extra_carts)
         if not passed:
             return 2 if ok else 1
         
@@ -270,11 +304,22 @@ def main_inner(raw_args):
         passed = True
 
     if args.output:
-        handle_output(args, cart, extra_carts)
+        with timed_stage(args.timings, "write"):
+            handle_output(args, cart, extra_carts)
 
     if not passed:
         return 2
 
+def handle_timings(args):
+    timings = args.timings
+    if args.print_timings:
+        sys.stdout.flush()
+        eprint("timings:")
+        for line in timings.format():
+            eprint("  " + line)
+    if args.timings_json:
+        file_write_json(args.timings_json, timings.to_json(), indent=4)
+
 def handle_input(args):
     output_is_export = args.format and args.format.is_export()
 
@@ -294,7 +339,7 @@ def handle_input(args):
         preprocessor = CustomPreprocessor() if args.custom_preprocessor else None
         main_cart = read_cart(args.input, args.input_format, size_handler=args.input_count, 
                               debug_handler=args.trace_input_compression, cart_name=args.cart,
-                              keep_compression=args.keep_compression, preprocessor=preprocessor,
+                              keep_compression=args.keep_compression, preprocessor=preprocessor, timings=args.timings,
                               extra_carts=extra_carts if output_is_export and not args.cart else None)
     except OSError as err:
         throw(f"cannot read cart: {err}")
@@ -338,7 +383,7 @@ def handle_input(args):
     for input, input_format, input_name, merge_sections in extra_inputs:
         preprocessor = CustomPreprocessor() if args.custom_preprocessor else None
         cart = read_cart(input, input_format,
-                         keep_compression=args.keep_compression, preprocessor=preprocessor)
+                         keep_compression=args.keep_compression, preprocessor=preprocessor, timings=args.timings)
         
         if input_name:
             cart.name = input_name
@@ -370,7 +415,7 @@ def handle_processing(args, main_cart, extra_carts):
         ok, errors = process_code(ctxt, src, input_count=args.input_count, count=args.count,
                                   lint=args.lint, minify=args.minify, rename=args.rename,
                                   unminify=args.unminify, stop_on_lint=not args.no_lint_fail,
-                                  fail=False, want_count=not args.no_count_tokenize)
+                                  fail=False, want_count=not args.no_count_tokenize, timings=args.timings)
         if errors:
             had_warns = True
             print("Lint warnings:" if ok else "Compilation errors:")
@@ -388,7 +433,9 @@ def handle_processing(args, main_cart, extra_carts):
         if args.count:
             write_code_size(cart, handler=args.count)
             if not (args.output and not args.format.is_src()) and not args.no_count_compress: # else, will be done in write_cart
-                write_compressed_size(cart, handler=args.count, fast_compress=args.fast_compression, debug_handler=args.trace_compression)
+                write_compressed_size(cart, handler=args.count, fast_compress=args.fast_compression, debug_handler=args.trace_compression,
+                                      optimal=args.optimal_compression, optimal_time_budget=args.optimal_compression_time,
+                                      effort=args.compression_effort, cache=args.cache, timings=args.timings)
         
         if args.version:
             print("version: %d, v%d.%d.%d:%d, %c" % (cart.version_id, *cart.version_tuple, cart.platform))
@@ -444,6 +491,8 @@ def handle_output(args, cart, extra_carts):
                        unicode_caps=args.unicode_caps, old_compress=args.old_compression,
                        force_compress=args.count or args.force_compression,
                        fast_compress=args.fast_compression, keep_compression=args.keep_compression,
+                       optimal=args.optimal_compression, optimal_time_budget=args.optimal_compression_time,
+                       effort=args.compression_effort, cache=args.cache, timings=args.timings,
                        template_image=args.template_image, template_only=args.template_only,
                        sections=args.output_sections,
                        cart_op=output_cart_op, cart_name=output_cart_name, target_name=output_cart_target,
@@ -460,4 +509,5 @@ def main(raw_args):
         return 1
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support() # for --compression-effort in packaged exes
     sys.exit(main(sys.argv[1:]))
@@ -74,7 +74,7 @@ def end_tests():
     
     return status
 
-def run_code(*args, exit_code=0):
+def run_code(*args, exit_code=0, with_stderr=False):
     actual_code = 0
     stdout = ""
     
@@ -84,7 +84,8 @@ def run_code(*args, exit_code=0):
     try:
         if g_use_exe:
             try:
-                stdout = subprocess.check_output([g_exe_path, *args], encoding="utf8")
+                stdout = subprocess.check_output([g_exe_path, *args], encoding="utf8",
+                                                 stderr=subprocess.STDOUT if with_stderr else None)
             except subprocess.CalledProcessError as e:
                 actual_code = e.returncode
                 stdout = e.stdout
@@ -92,7 +93,7 @@ def run_code(*args, exit_code=0):
             stdout_io = StringIO()
             try:
                 with patch.object(sys, "argv", ["dontcare", *args]):
-                    with patch.object(sys, "stdout", stdout_io):
+                    with patch.object(sys, "stdout", stdout_io), patch.object(sys, "stderr", stdout_io if with_stderr else sys.stderr):
                         exec_script_by_path(g_code_file, name="__main__")
             except SystemExit as e:
                 actual_code = e.code or 0
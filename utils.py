@@ -1,4 +1,4 @@
-import os, sys, io, bisect, random, copy, collections, itertools, struct, array, re, traceback, hashlib, math, string, weakref, operator, heapq, time, json
+import os, sys, io, bisect, random, copy, collections, itertools, struct, array, re, traceback, hashlib, math, string, weakref, operator, heapq, time, json, tempfile, contextlib
 from datetime import datetime, timedelta
 from functools import reduce, total_ordering, lru_cache
 from copy import copy, deepcopy
@@ -1242,6 +1242,15 @@ class BinaryBitWriter(BinaryBase):
 
     def bit(m, v):
         m.bits(1, v)
+
+    def many_bits_le(m, n, v):
+        """Like bits_le, but efficient for large n"""
+        total = m._bit + n
+        v = m._byte | ((v & ((1 << n) - 1)) << m._bit)
+        num_bytes = total // 8
+        m.f.write(v.to_bytes(num_bytes + 1, "little")[:num_bytes])
+        m._byte = (v >> (num_bytes * 8)) & 0xff
+        m._bit = total % 8
     
     def close(m):
         m.flush()
@@ -2355,6 +2364,138 @@ def try_dir_paths(path, defval = None):
     except Exception:
         return defval
 
+class DiskCache:
+    """A size-bounded cache of binary data in a directory, keyed by strings (or bytes).
+    Writes are atomic and least-recently-used entries are evicted, so the directory can be shared by parallel processes"""
+
+    def __init__(m, path, max_size=0x10000000, salt=""):
+        m.path, m.max_size, m.salt = path, max_size, salt
+        dir_ensure_exists(path)
+
+    def _entry_path(m, key):
+        if isinstance(key, str):
+            key = key.encode("utf-8", "surrogatepass")
+        digest = hashlib.sha256(m.salt.encode() + b"\0" + key).hexdigest()
+        return path_join(m.path, digest + ".bin")
+
+    def get(m, key):
+        """Return the data stored under 'key', or None"""
+        path = m._entry_path(key)
+        try:
+            data = file_read(path)
+            os.utime(path) # mark as recently used
+        except OSError:
+            return None
+        return data
+
+    def set(m, key, data):
+        """Store 'data' under 'key', evicting old entries if needed"""
+        fd, temp_path = tempfile.mkstemp(dir=m.path, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, m._entry_path(key))
+        except OSError:
+            file_delete(temp_path)
+            return
+        m.evict()
+
+    def evict(m):
+        """Delete the least-recently-used entries until the cache fits within max_size"""
+        entries = []
+        total_size = 0
+        for name in try_dir_names(m.path, ()):
+            if name.endswith(".bin"):
+                try:
+                    stat = os.stat(path_join(m.path, name))
+                except OSError:
+                    continue # deleted by someone else
+                entries.append((stat.st_mtime, stat.st_size, name))
+                total_size += stat.st_size
+
+        if total_size > m.max_size:
+            for _, size, name in sorted(entries):
+                try:
+                    os.remove(path_join(m.path, name))
+                except OSError:
+                    pass
+                total_size -= size
+                if total_size <= m.max_size:
+                    break
+
+class MemoryCache:
+    """An in-memory cache with the same interface as DiskCache, optionally in front of another such cache"""
+
+    def __init__(m, backing=None):
+        m.backing = backing
+        m.entries = {}
+
+    def get(m, key):
+        """Return the data stored under 'key', or None"""
+        data = m.entries.get(key)
+        if data is None and m.backing:
+            data = m.backing.get(key)
+            if data is not None:
+                m.entries[key] = data
+        return data
+
+    def set(m, key, data):
+        """Store 'data' under 'key'"""
+        m.entries[key] = data
+        if m.backing:
+            m.backing.set(key, data)
+
+class StageTimings:
+    """Measures the wall-clock time spent in named stages of work.
+    Time spent in a nested stage isn't counted towards the enclosing stage, so the stages add up to (at most) the total"""
+
+    def __init__(m):
+        m.start = m.resume_time = time.perf_counter()
+        m.stages = {} # name -> [seconds, calls], in order of first use
+        m.stack = []
+
+    def _add_time(m, name, now):
+        m.stages[name][0] += now - m.resume_time
+        m.resume_time = now
+
+    @contextlib.contextmanager
+    def stage(m, name):
+        """A context manager measuring the time spent within it as part of stage 'name'"""
+        now = time.perf_counter()
+        if m.stack:
+            m._add_time(m.stack[-1], now)
+        m.resume_time = now
+
+        m.stages.setdefault(name, [0, 0])[1] += 1
+        m.stack.append(name)
+        try:
+            yield
+        finally:
+            m._add_time(name, time.perf_counter())
+            m.stack.pop()
+
+    @property
+    def total(m):
+        return time.perf_counter() - m.start
+
+    def format(m):
+        """Return the timings as human-readable lines"""
+        lines = [f"{name:<12} {secs * 1000:10.2f} ms" + (f" ({calls} times)" if calls > 1 else "")
+                 for name, (secs, calls) in m.stages.items()]
+        lines.append(f"{'total':<12} {m.total * 1000:10.2f} ms")
+        return lines
+
+    def to_json(m):
+        """Return the timings as a json-compatible dict (times in seconds)"""
+        return {
+            "stages": [{"name": name, "time": secs, "calls": calls} for name, (secs, calls) in m.stages.items()],
+            "total": m.total,
+        }
+
+def timed_stage(timings, name):
+    """Measure a stage of work via timings.stage, if timings isn't None"""
+    return timings.stage(name) if timings else contextlib.nullcontext()
+
 def filename_fixup(filename):
     """Fixup a filename to be valid"""
     fixed = "".join([ch if ch not in r"\/:*?<>|" else "_" for ch in filename])